@@ -0,0 +1,40 @@
+from typing import Dict, List, Iterable
+
+
+def search_criteria(folders: Iterable[str], recursive: bool = True) -> List[Dict]:
+    """
+        Return the AQL criteria matching every file in any of folders, to be combined with $or
+        Folders are artifactory paths starting with the repo name, e.g. sw-generic-daas-artifacts-dev/inference-engine/...
+    """
+    criteria = []
+    for folder in sorted(set(folders)):
+        repo, _, path = folder.strip("/").partition("/")
+        # Files directly in the folder, and files in any of its subfolders
+        criteria.append({"repo": repo, "path": path})
+        if recursive:
+            criteria.append({"repo": repo, "path": {"$match": f"{path}/*"}})
+    return criteria
+
+
+def build_search_spec(folders: Iterable[str]) -> Dict:
+    """Build a jf file spec with a single AQL query that matches every file under any of folders"""
+    return {"files": [{"aql": {"items.find": {"$or": search_criteria(folders)}}}]}
+
+
+def split_by_folder(files: List, folders: Iterable[str]) -> Dict[str, List]:
+    """
+        Split a list of file ObjectInfo (see storage.StorageBackend) into folder -> files under that folder (recursively)
+        A file is assigned to every requested folder that contains it, so nested folders are supported
+    """
+    by_folder = {folder: [] for folder in folders}
+    normalized = {}
+    for folder in by_folder:
+        normalized.setdefault(folder.strip("/"), []).append(folder)
+
+    for file_metadata in files:
+        parts = file_metadata.path.split("/")
+        # Walk up the file's parent folders and look each one up
+        for i in range(len(parts) - 1, 0, -1):
+            for folder in normalized.get("/".join(parts[:i]), []):
+                by_folder[folder].append(file_metadata)
+    return by_folder
@@ -0,0 +1,215 @@
+"""
+    End-to-end benchmark of InventoryComparer().write() without live GCS or artifactory
+    gsutil and jf are replaced by stand-ins that replay outputs recorded from the real tools,
+    with configurable latency, jitter and failure rate. Each scenario runs in a fresh interpreter
+    with its own caches, and reports the wall time, the number of remote calls and the PEF cache hit ratio:
+        cold - empty caches
+        warm - the caches left by the cold run
+
+    Record the outputs of the real tools once (needs gsutil / jf access), then benchmark offline:
+        python bench_compare.py --record
+        python bench_compare.py --latency 0.8 --jitter 0.3 --save baseline.json
+        python bench_compare.py --latency 0.8 --jitter 0.3 --baseline baseline.json
+
+    Usage: python bench_compare.py [--recordings DIR] [--record] [--latency S] [--jitter S] [--failure-rate P]
+                                   [--repeat N] [--save FILE] [--baseline FILE]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List
+
+RECORDINGS_DIR = Path(__file__).parent / ".bench_recordings"
+STAND_IN_COMMANDS = ["gsutil", "jf"]
+
+# Installed as both gsutil and jf. Looks up the recorded output for its command line in BENCH_RECORDINGS,
+# or in record mode runs the real tool (the next one on PATH) and saves its output there.
+STAND_IN = r'''#!{python}
+import hashlib, json, os, random, shutil, subprocess, sys, time
+
+def call_key(argv):
+    """The command line, with spec files (jf rt s --spec <tmp file>) replaced by the hash of their contents"""
+    key = [os.path.basename(argv[0])]
+    args = iter(argv[1:])
+    for arg in args:
+        key.append(arg)
+        if arg == "--spec":
+            with open(next(args), "rb") as f:
+                key.append("sha1:" + hashlib.sha1(f.read()).hexdigest())
+    return " ".join(key)
+
+key = call_key(sys.argv)
+recording = os.path.join(os.environ["BENCH_RECORDINGS"], hashlib.sha1(key.encode()).hexdigest() + ".json")
+with open(os.environ["BENCH_CALL_LOG"], "a") as f:
+    f.write(key + "\n")
+
+if os.environ.get("BENCH_RECORD") == "1":
+    stand_in_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
+    path = os.pathsep.join(p for p in os.environ["PATH"].split(os.pathsep) if os.path.abspath(p) != stand_in_dir)
+    real_tool = shutil.which(os.path.basename(sys.argv[0]), path=path)
+    result = subprocess.run([real_tool, *sys.argv[1:]], capture_output=True, text=True)
+    with open(recording, "w") as f:
+        json.dump({{"key": key, "returncode": result.returncode, "stdout": result.stdout, "stderr": result.stderr}}, f)
+    sys.stdout.write(result.stdout)
+    sys.stderr.write(result.stderr)
+    sys.exit(result.returncode)
+
+time.sleep(max(0.0, float(os.environ["BENCH_LATENCY"]) + random.uniform(-1, 1) * float(os.environ["BENCH_JITTER"])))
+if random.random() < float(os.environ["BENCH_FAILURE_RATE"]):
+    sys.stderr.write("bench: injected failure\n")
+    sys.exit(1)
+try:
+    with open(recording) as f:
+        recorded = json.load(f)
+except FileNotFoundError:
+    sys.stderr.write(f"bench: no recording for '{{key}}', run bench_compare.py --record\n")
+    sys.exit(1)
+sys.stdout.write(recorded["stdout"])
+sys.stderr.write(recorded["stderr"])
+sys.exit(recorded["returncode"])
+'''
+
+# Runs a single scenario in the child interpreter, with the caches and the delta state moved to cache_dir
+CHILD = r'''
+import json, sys, time
+from pathlib import Path
+cache_dir, result_file = Path(sys.argv[1]), sys.argv[2]
+
+import compare_pefs, compare_models
+from metadata_cache import MetadataCache
+compare_pefs.CACHE = MetadataCache(cache_dir / compare_pefs.CACHE_DB_FILE.name)
+compare_models.MANIFEST_CACHE = MetadataCache(cache_dir / compare_models.MANIFEST_CACHE_DB_FILE.name)
+import compare_inventories
+compare_inventories.COMPARISON_CACHE = MetadataCache(cache_dir / compare_inventories.COMPARISON_CACHE_DB_FILE.name)
+compare_inventories.DELTA_STATE_FILE = cache_dir / compare_inventories.DELTA_STATE_FILE.name
+from compare_inventories import InventoryComparer
+
+start = time.perf_counter()
+error = None
+try:
+    InventoryComparer().write()
+except Exception as e:
+    error = f"{type(e).__name__}: {e}"
+with open(result_file, "w") as f:
+    json.dump({
+        "wall_time": time.perf_counter() - start,
+        "pef_lookups": sum(compare_pefs.LOOKUP_COUNTS.values()),
+        "pef_fetches": sum(compare_pefs.FETCH_COUNTS.values()),
+        "error": error,
+    }, f)
+'''
+
+
+def install_stand_ins(bin_dir: Path):
+    script = STAND_IN.format(python=sys.executable)
+    for command in STAND_IN_COMMANDS:
+        stand_in = bin_dir / command
+        stand_in.write_text(script)
+        stand_in.chmod(0o755)
+
+
+def run_scenario(work_dir: Path, cache_dir: Path, env: Dict[str, str]) -> Dict:
+    """Run InventoryComparer().write() in a fresh interpreter in work_dir and return its measurements"""
+    call_log, result_file = work_dir / "calls.log", work_dir / "result.json"
+    call_log.write_text("")
+    cache_dir.mkdir(exist_ok=True)
+    (work_dir / "output").mkdir(exist_ok=True)
+    env = dict(env, BENCH_CALL_LOG=str(call_log), PYTHONPATH=str(Path(__file__).parent.resolve()))
+    with open(work_dir / "run.log", "w") as log:
+        subprocess.run([sys.executable, "-c", CHILD, str(cache_dir), str(result_file)], cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    result = json.loads(result_file.read_text())
+    calls = [line for line in call_log.read_text().splitlines() if line]
+    # Group calls by tool and subcommand, e.g. 'gsutil ls -L' or 'jf rt s'
+    result["remote_calls"] = len(calls)
+    result["calls_by_command"] = dict(Counter(" ".join(c.split()[:3 if c.startswith("jf") else 2]) for c in calls))
+    lookups = result["pef_lookups"]
+    result["pef_cache_hit_ratio"] = (lookups - result["pef_fetches"]) / lookups if lookups else None
+    return result
+
+
+def summarize(runs: List[Dict]) -> Dict:
+    """Median wall time over the repetitions of a scenario, calls and hits from the first one"""
+    summary = dict(runs[0])
+    summary["wall_time"] = statistics.median(r["wall_time"] for r in runs)
+    summary["errors"] = [r["error"] for r in runs if r["error"]]
+    del summary["error"]
+    return summary
+
+
+def print_results(results: Dict[str, Dict], baseline: Dict[str, Dict] = None):
+    print(f"{'scenario':<10}{'wall time':>12}{'remote calls':>15}{'PEF cache hits':>17}")
+    for scenario, result in results.items():
+        hit_ratio = result["pef_cache_hit_ratio"]
+        hits = f"{hit_ratio:.0%}" if hit_ratio is not None else "-"
+        line = f"{scenario:<10}{result['wall_time']:>11.2f}s{result['remote_calls']:>15}{hits:>17}"
+        if baseline and scenario in baseline:
+            line += f"   ({result['wall_time'] / baseline[scenario]['wall_time']:.2f}x baseline wall time, " \
+                    f"{result['remote_calls'] - baseline[scenario]['remote_calls']:+d} calls)"
+        print(line)
+        for command, count in sorted(result["calls_by_command"].items()):
+            print(f"    {command:<20}{count:>6}")
+        for error in result["errors"]:
+            print(f"    FAILED: {error}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recordings", type=Path, default=RECORDINGS_DIR)
+    parser.add_argument("--record", action="store_true", help="Run once against the real gsutil / jf and record their outputs")
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds added to every remote call")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Latency varies uniformly by +/- this many seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of remote calls that fail")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--save", type=Path, help="Write the results to this json file")
+    parser.add_argument("--baseline", type=Path, help="Compare against results saved with --save")
+    args = parser.parse_args()
+
+    args.recordings.mkdir(exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix="bench_compare_") as tmp:
+        tmp = Path(tmp)
+        bin_dir = tmp / "bin"
+        bin_dir.mkdir()
+        install_stand_ins(bin_dir)
+        env = dict(
+            os.environ,
+            PATH=f"{bin_dir}{os.pathsep}{os.environ['PATH']}",
+            # The stand-ins replace the CLIs, so the CLI backends must be used
+            STORAGE_BACKEND="cli",
+            BENCH_RECORDINGS=str(args.recordings.resolve()),
+            BENCH_RECORD="1" if args.record else "0",
+            BENCH_LATENCY=str(args.latency),
+            BENCH_JITTER=str(args.jitter),
+            BENCH_FAILURE_RATE=str(args.failure_rate),
+        )
+
+        if args.record:
+            # The warm run makes different calls (e.g. a smaller artifactory search), record both
+            cache_dir = tmp / "record_cache"
+            for scenario in ["cold", "warm"]:
+                result = run_scenario(tmp, cache_dir, env)
+                print(f"Recorded {result['remote_calls']} calls of the {scenario} run to {args.recordings} in {result['wall_time']:.1f}s")
+                if result["error"]:
+                    print(f"FAILED: {result['error']}, see the recordings for the failed call")
+                    sys.exit(1)
+            sys.exit(0)
+
+        runs = {"cold": [], "warm": []}
+        for i in range(args.repeat):
+            cache_dir = tmp / f"cache{i}"
+            runs["cold"].append(run_scenario(tmp, cache_dir, env))
+            runs["warm"].append(run_scenario(tmp, cache_dir, env))
+        results = {scenario: summarize(scenario_runs) for scenario, scenario_runs in runs.items()}
+
+    print(f"InventoryComparer().write(), latency {args.latency}s +/- {args.jitter}s, failure rate {args.failure_rate:.0%}, "
+          f"median of {args.repeat}")
+    baseline = json.loads(args.baseline.read_text()) if args.baseline else None
+    print_results(results, baseline)
+    if args.save:
+        args.save.write_text(json.dumps(results, indent=2))
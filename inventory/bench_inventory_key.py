@@ -0,0 +1,143 @@
+"""
+    Micro-benchmark for InventoryKey: build keys for N inventory rows, then hash, stringify and group them
+    the way compare_inventories does. Compares against the previous dataclass implementation.
+
+    Usage: python bench_inventory_key.py [--rows 100000] [--repeat 3]
+"""
+import argparse
+import time
+from dataclasses import dataclass, fields
+from typing import Dict, Union
+
+from schemas import InventoryKey
+
+
+@dataclass(frozen=True)
+class LegacyInventoryKey:
+    """The InventoryKey implementation before keys were slotted and precomputed, kept as the benchmark baseline"""
+    app_name: str
+    param_count: str
+    sd: bool
+    max_seq_length: int
+
+    fields_aliases = InventoryKey.fields_aliases
+
+    @classmethod
+    def lookup_field(cls, fieldname: str, obj):
+        for alias in LegacyInventoryKey.fields_aliases[fieldname]:
+            if alias in obj:
+                return obj[alias]
+        raise KeyError
+
+    @classmethod
+    def from_input(cls, obj: Union[Dict, object]) -> "LegacyInventoryKey":
+        def to_bool(val):
+            if not isinstance(val, str):
+                return bool(val)
+            return val.lower() == "true"
+
+        class InvalidDictForInventoryKey(Exception):
+            pass
+
+        class InvalidObjectForInventoryKey(Exception):
+            pass
+
+        init_kwargs = {}
+        for field in fields(cls):
+            if field.type == bool:
+                val = to_bool(LegacyInventoryKey.lookup_field(field.name, obj))
+            else:
+                val = field.type(LegacyInventoryKey.lookup_field(field.name, obj))
+            init_kwargs[field.name] = val
+        return cls(**init_kwargs)
+
+    def __str__(self):
+        s = "-".join(tuple(str(getattr(self, x.name)) for x in fields(LegacyInventoryKey)))
+        s = s.replace(" ", "_")
+        s = s.replace(".", "d")
+        return s
+
+    @property
+    def group_id(self):
+        return "-".join(str(self).split("-")[:-1])
+
+
+def make_rows(n: int):
+    """Return a CSV header and n studio-inventory-like rows"""
+    header = ["model_name", "model_checkpoint_name", "model_app_name", "model_parameter_count", "spec_decoding",
+              "mode", "rdu_arch", "model_parallel_rdus", "max_seq_length", "batch_sizes", "pef_path", "model_path", "vocab_size"]
+    seq_lens = [4096, 8192, 16384, 32768, 65536, 131072]
+    rows = []
+    for i in range(n):
+        rows.append({
+            "model_name": f"model-{i}",
+            "model_checkpoint_name": f"model-{i}",
+            "model_app_name": f"Samba1 App{i % 500}.{i % 7} Experts",
+            "model_parameter_count": f"{i % 40}b",
+            "spec_decoding": "True" if i % 2 else "False",
+            "mode": "infer",
+            "rdu_arch": "sn40-16",
+            "model_parallel_rdus": "16",
+            "max_seq_length": str(seq_lens[i % len(seq_lens)]),
+            "batch_sizes": "[1, 4, 8]",
+            "pef_path": f"{{{{ARTIFACTS_REPO}}}}/pefs/{i}/",
+            "model_path": f"{{{{ARTIFACTS_REPO}}}}/checkpoints/{i}/",
+            "vocab_size": "128256",
+        })
+    return header, rows
+
+
+def run_workload(keys):
+    """What compare_inventories does with keys: dict/set membership, ids, group ids and sorting by id"""
+    inventory = {key: None for key in keys}
+    other = set(keys[::2])
+    common = [k for k in inventory if k in other]
+    groups = {}
+    for key in keys:
+        groups.setdefault(key.group_id, []).append(key)
+    ids = [str(k) for k in sorted(common, key=str)]
+    return len(ids) + len(groups)
+
+
+def bench_legacy(header, rows):
+    keys = [LegacyInventoryKey.from_input(row) for row in rows]
+    return keys
+
+
+def bench_current(header, rows):
+    to_key = InventoryKey.row_factory(header)
+    return [to_key(row) for row in rows]
+
+
+def timed(fn, *args, repeat: int):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    header, rows = make_rows(args.rows)
+    legacy_keys, current_keys = bench_legacy(header, rows), bench_current(header, rows)
+    assert [str(k) for k in legacy_keys] == [str(k) for k in current_keys]
+    assert [k.group_id for k in legacy_keys] == [k.group_id for k in current_keys]
+
+    results = {
+        "build (legacy)": timed(bench_legacy, header, rows, repeat=args.repeat),
+        "build": timed(bench_current, header, rows, repeat=args.repeat),
+        "compare (legacy)": timed(run_workload, legacy_keys, repeat=args.repeat),
+        "compare": timed(run_workload, current_keys, repeat=args.repeat),
+    }
+    print(f"InventoryKey benchmark, {args.rows} rows, best of {args.repeat}")
+    for name, elapsed in results.items():
+        print(f"  {name:<20} {elapsed * 1000:10.1f} ms")
+    print(f"  build speedup        {results['build (legacy)'] / results['build']:10.1f}x")
+    print(f"  compare speedup      {results['compare (legacy)'] / results['compare']:10.1f}x")
@@ -0,0 +1,166 @@
+"""
+    Scale benchmark for the in-memory stages of the pipeline, on synthetic fleets (see synthetic_inventory.py)
+    For each fleet size, measures the time (best of --repeat) and the peak traced memory of:
+        active_deployments  parse the cluster tfvars
+        cloud_configs       InferenceDeployment / CloudConfig construction from already loaded yaml
+        merge               get_cloud_configs
+        write_inventory     cloud inventory csv and jsonl
+        read_jsonl          read the id, batch_sizes and cloud_pefs_json columns of the cloud inventory jsonl
+        get_inventories     read both inventories into InventoryKey -> row
+        compare_keys        InventoryComparer() and the cloud-only / studio-only rows (no remote lookups)
+
+    Save budgets once, then check later changes against them:
+        python bench_pipeline.py --sizes 10 100 1000 10000 --save-budgets bench_pipeline_budgets.json
+        python bench_pipeline.py --sizes 10 100 1000 10000 --budgets bench_pipeline_budgets.json
+    Exits with 1 if any stage exceeds its time or memory budget by more than --tolerance
+
+    --unfiltered-ratio adds studio rows for other architectures and modes, which get_inventories reads but doesn't keep
+
+    Usage: python bench_pipeline.py [--sizes N ...] [--repeat 3] [--data-dir DIR] [--unfiltered-ratio R]
+                                    [--budgets FILE] [--save-budgets FILE] [--tolerance 0.25]
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Dict, List
+
+import cloud_inventory
+import compare_inventories
+import tfvars
+import utils
+import yaml_snapshot
+from schemas import InferenceDeployment
+from synthetic_inventory import generate, CLUSTER_TFVARS, DEPLOYMENTS_DIR, MODEL_MAPPINGS, STUDIO_INVENTORY, VALUES_YAML
+
+DEFAULT_SIZES = [10, 100, 1000]
+# Differences smaller than this are noise, not regressions, whatever the tolerance
+MIN_REGRESSION = {"time": 0.005, "peak_mb": 1.0}
+
+
+def use_fleet(fleet: Path, cloud_inventory_file: Path):
+    """Point the pipeline at a synthetic fleet instead of the real checkouts"""
+    # The synthetic files are only read once, don't leave snapshots of them behind
+    yaml_snapshot.SNAPSHOTS_ENABLED = False
+    utils.CONFIG.register("model_mappings", lambda: utils.load_yaml(fleet / MODEL_MAPPINGS))
+    utils.CONFIG.register("cloud_models", lambda: utils.load_yaml(fleet / VALUES_YAML)["models"])
+    utils.CONFIG.reset()
+    cloud_inventory.OUTPUT_FILE = cloud_inventory_file
+    compare_inventories.CLOUD_INVENTORY_PATH = cloud_inventory_file
+    compare_inventories.STUDIO_INVENTORY_PATH = fleet / STUDIO_INVENTORY
+
+
+def build_stages(fleet: Path) -> List[tuple]:
+    """
+        Return the (name, function) of every stage. Each function takes the previous stage's output
+        Deployment yamls are loaded up front, so yaml parsing isn't part of any stage
+    """
+    docs = {p.stem: yaml_snapshot.parse_yaml(p.read_bytes()) for p in sorted((fleet / DEPLOYMENTS_DIR).iterdir())}
+    cluster_files = sorted((fleet / CLUSTER_TFVARS).iterdir())
+
+    def active_deployments(_):
+        active = set()
+        for cluster_file in cluster_files:
+            active.update(tfvars.read_cluster_deployments(cluster_file))
+        return active
+
+    def cloud_configs(active):
+        return {name: InferenceDeployment(**doc, deployment=name) for name, doc in docs.items() if doc["metadata"]["name"] in active}
+
+    def write_inventory(configs):
+        cloud_inventory.write_inventory(configs)
+        return configs
+
+    def compare_keys(_):
+        comparer = compare_inventories.InventoryComparer()
+        return comparer._cloud_only_rows(), comparer._studio_only_rows()
+
+    return [
+        ("active_deployments", active_deployments),
+        ("cloud_configs", cloud_configs),
+        ("merge", cloud_inventory.get_cloud_configs),
+        ("write_inventory", write_inventory),
+        ("read_jsonl", lambda _: list(utils.read_jsonl(utils.jsonl_path(cloud_inventory.OUTPUT_FILE), columns=["id", "batch_sizes", "cloud_pefs_json"]))),
+        ("get_inventories", lambda _: compare_inventories.get_inventories()),
+        ("compare_keys", compare_keys),
+    ]
+
+
+def run_stages(stages: List[tuple], repeat: int) -> Dict[str, Dict[str, float]]:
+    """
+        Run the stages in order repeat times and return stage -> {"time": best seconds, "peak_mb": peak traced memory}
+        Every repetition starts from scratch
+        Memory is measured in an extra repetition, tracemalloc slows everything down too much to time it at the same time
+    """
+    results = {name: {"time": float("inf"), "peak_mb": 0.0} for name, _ in stages}
+    for _ in range(repeat):
+        value = None
+        for name, stage in stages:
+            start = time.perf_counter()
+            value = stage(value)
+            results[name]["time"] = min(results[name]["time"], time.perf_counter() - start)
+
+    tracemalloc.start()
+    value = None
+    for name, stage in stages:
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        value = stage(value)
+        results[name]["peak_mb"] = (tracemalloc.get_traced_memory()[1] - current) / 2**20
+    tracemalloc.stop()
+    return results
+
+
+def check_budgets(results: Dict[str, Dict], budgets: Dict[str, Dict], tolerance: float) -> List[str]:
+    """Return a message for every stage whose time or peak memory is over its budget by more than tolerance"""
+    regressions = []
+    for size, stages in results.items():
+        for stage, measured in stages.items():
+            budget = budgets.get(size, {}).get(stage)
+            if budget is None:
+                continue
+            for metric in ["time", "peak_mb"]:
+                over = measured[metric] - budget[metric]
+                if over > budget[metric] * tolerance and over > MIN_REGRESSION[metric]:
+                    regressions.append(f"{size} deployments, {stage}: {metric} {measured[metric]:.3f} > budget {budget[metric]:.3f}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Numbers of active deployments")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--data-dir", type=Path, help="Keep the generated fleets here and reuse them, instead of a temporary directory")
+    parser.add_argument("--unfiltered-ratio", type=float, default=0.0, help="Studio rows for other architectures and modes, per compared studio row")
+    parser.add_argument("--budgets", type=Path, help="Check the results against budgets saved with --save-budgets")
+    parser.add_argument("--save-budgets", type=Path, help="Save the results as budgets")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed fraction over budget before flagging a regression")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="bench_pipeline_") as tmp:
+        data_dir = args.data_dir or Path(tmp)
+        for size in args.sizes:
+            fleet = data_dir / (f"fleet-{size}" if not args.unfiltered_ratio else f"fleet-{size}-unfiltered-{args.unfiltered_ratio}")
+            if not (fleet / STUDIO_INVENTORY).exists():
+                generate(fleet, size, unfiltered_ratio=args.unfiltered_ratio)
+            use_fleet(fleet, Path(tmp) / f"cloud_inventory-{size}.csv")
+            stages = build_stages(fleet)
+            results[str(size)] = run_stages(stages, args.repeat)
+
+            print(f"\n{size} deployments, best of {args.repeat}")
+            for stage, measured in results[str(size)].items():
+                print(f"  {stage:<20}{measured['time'] * 1000:10.1f} ms{measured['peak_mb']:10.1f} MB")
+
+    if args.save_budgets:
+        args.save_budgets.write_text(json.dumps(results, indent=2))
+        print(f"\nSaved budgets to {args.save_budgets}")
+    if args.budgets:
+        regressions = check_budgets(results, json.loads(args.budgets.read_text()), args.tolerance)
+        print(f"\n{len(regressions)} regressions against {args.budgets} (tolerance {args.tolerance:.0%})")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1 if regressions else 0)
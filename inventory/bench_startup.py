@@ -0,0 +1,60 @@
+"""
+    Import-time benchmark for the inventory entry points
+    Imports each module in a fresh interpreter and reports the wall time on top of a bare interpreter start,
+    along with the slowest imports reported by python -X importtime
+
+    Usage: python bench_startup.py [--repeat 5] [--top 5] [module ...]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+ENTRY_POINTS = ["cloud_inventory", "compare_inventories", "compare_models", "compare_pefs"]
+
+
+def time_command(code: str, repeat: int) -> float:
+    """Median wall time in seconds to run code in a fresh interpreter"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=Path(__file__).parent, check=True, capture_output=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def slowest_imports(module: str, top: int) -> List[Tuple[float, str]]:
+    """Return the (cumulative seconds, module) of the slowest top-level imports when importing module"""
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=Path(__file__).parent, check=True, capture_output=True, text=True
+    )
+    imports = []
+    # Lines look like: 'import time:       self [us] |  cumulative | imported package'
+    for line in output.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Only the imports made directly by the entry point, nested imports are included in their cumulative time
+        if name.startswith("   ") and not name.startswith("     "):
+            imports.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modules", nargs="*", default=ENTRY_POINTS)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5)
+    args = parser.parse_args()
+
+    baseline = time_command("pass", args.repeat)
+    print(f"Bare interpreter start: {baseline * 1000:.1f} ms (median of {args.repeat})")
+    for module in args.modules:
+        elapsed = time_command(f"import {module}", args.repeat) - baseline
+        print(f"\n{module}: {elapsed * 1000:.1f} ms")
+        for cumulative, name in slowest_imports(module, args.top):
+            print(f"  {cumulative * 1000:8.1f} ms  {name}")
@@ -1,62 +1,193 @@
-import yaml
 import os
+import pickle
+import argparse
+import tempfile
 from schemas import InferenceDeployment, CloudConfig, InventoryKey
 import csv
-from utils import CLOUD_PROD_DEPLOYMENTS, SN_IAC_PROD_CLUSTER_FILES
+from utils import load_yaml, file_sha256, CLOUD_PROD_DEPLOYMENTS, CLOUD_MODELS_YAML, MODEL_MAPPINGS_FILE, get_cluster_files, CLOUD_INVENTORY_PATH, CLOUD_INVENTORY_GTM_PATH, jsonl_path, write_jsonl
 from pathlib import Path
-from typing import Dict
-from itertools import takewhile
+from tfvars import get_cluster_deployments
+from typing import Dict, List, Tuple, Union
+from concurrent.futures import ProcessPoolExecutor
+import metrics
+from metrics import METRICS, log
 
-OUTPUT_FILE = Path(__file__).parent / "output/cloud_inventory.csv"
-GTM_OUTPUT_FILE = Path(__file__).parent / "output/cloud_inventory_gtm.csv"
+OUTPUT_FILE = CLOUD_INVENTORY_PATH
+GTM_OUTPUT_FILE = CLOUD_INVENTORY_GTM_PATH
 
 
-def load_deployments(active_deployments):
-    deployment_configs = [CLOUD_PROD_DEPLOYMENTS / f for f in os.listdir(CLOUD_PROD_DEPLOYMENTS)]
-    deployments = {}
-    inference_deployments = {}
-    for config in deployment_configs:
-        with open(config) as f:
-            deployment = yaml.safe_load(f)
-            # Only parse active deployments
-            if deployment["metadata"]["name"] not in active_deployments:
+# Number of processes used to parse and validate deployment files
+MAX_WORKERS = int(os.environ.get("CLOUD_INVENTORY_WORKERS", os.cpu_count() or 1))
+
+# Incremental builds keep the parsed deployments of the previous run here, with a fingerprint of each deployment file
+MANIFEST_FILE = Path(__file__).parent / ".cloud_inventory_manifest.pickle"
+# Bump when the manifest format changes, manifests of other versions are discarded without loading their deployments
+MANIFEST_VERSION = 2
+# Files that affect how every deployment is turned into CloudConfigs, if any of them change the manifest is discarded
+MANIFEST_INPUTS = [
+    MODEL_MAPPINGS_FILE,
+    CLOUD_MODELS_YAML,
+    Path(__file__).parent / "schemas.py",
+    Path(__file__).parent / "utils.py",
+]
+
+
+def read_deployment_name(config: Path) -> Union[str, None]:
+    """
+        Read metadata.name from a deployment yaml without parsing the whole document
+        Only handles a plain scalar name directly under a top-level metadata key, returns None for anything else
+    """
+    with open(config) as f:
+        in_metadata, indent = False, None
+        for line in f:
+            stripped = line.strip()
+            if not stripped or stripped.startswith("#"):
+                continue
+            line_indent = len(line) - len(line.lstrip())
+            if line_indent == 0:
+                if in_metadata:
+                    return None
+                in_metadata = stripped == "metadata:"
+                continue
+            if not in_metadata:
+                continue
+            # Only look at keys directly under metadata
+            if indent is None:
+                indent = line_indent
+            if line_indent != indent or not stripped.startswith("name:"):
                 continue
-            deployments[config] = deployment
-    for config, deployment in deployments.items():
-        print(f"Processing {config}")
-        d = InferenceDeployment(**deployment, deployment=config.stem)
-        inference_deployments[config.stem] = d
+            name = stripped[len("name:"):].split(" #")[0].strip()
+            if name[:1] in ("'", '"') and name[-1:] == name[:1] and len(name) > 1:
+                name = name[1:-1]
+            elif not name or name[0] in "&*!|>{[%@`":
+                return None
+            return name
+    return None
 
-    return inference_deployments
 
-def get_active_deployments():
-
-    def read_coe_values_from_cluster_spec(cluster_spec):
-        yaml_content = ""
-        line = cluster_spec.readline()
-        # Skip to the beginning of the coe-values.yaml definition
-        while not "EOVAL" in line:
-            line = cluster_spec.readline()
-        # Read the first line of the yaml definition
-        line = cluster_spec.readline()
-        # Yaml is indented in the .tfvars file, need to unindent it
-        indent = len(''.join(takewhile(str.isspace, line)))
-        while not "EOVAL" in line:
-            yaml_content += line[indent:]
-            line = cluster_spec.readline()
-        return yaml.safe_load(yaml_content)
+def load_deployment(config: Path) -> InferenceDeployment:
+    """Parse and validate a single deployment file"""
+    log(f"Processing {config}")
+    with METRICS.span("parse/deployment", deployment=config.stem):
+        return InferenceDeployment(**load_yaml(config), deployment=config.stem)
+
+
+def _load_deployment_in_worker(config: Path) -> Tuple[InferenceDeployment, Dict]:
+    """load_deployment in a worker process, also returns the metrics it recorded for the parent to merge"""
+    # The worker's METRICS may be a copy of the parent's (fork) or hold the previous task's metrics
+    METRICS.reset()
+    deployment = load_deployment(config)
+    return deployment, METRICS.export()
+
+
+def parse_deployments(configs: List[Path]) -> List[InferenceDeployment]:
+    """Parse and validate deployment files, in MAX_WORKERS processes if there are several. Results are in configs order"""
+    workers = min(MAX_WORKERS, len(configs))
+    if workers <= 1:
+        return [load_deployment(config) for config in configs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_load_deployment_in_worker, configs))
+    for _, recorded in results:
+        METRICS.merge(recorded)
+    return [deployment for deployment, _ in results]
+
+
+def load_manifest() -> Dict:
+    """
+        Return the manifest from the previous incremental build, or an empty one if it is missing, unreadable,
+        written by another MANIFEST_VERSION or any MANIFEST_INPUTS changed
+        Format: {"inputs": {path: sha256}, "deployments": {file name: {"sha256": ..., "name": ..., "deployment": InferenceDeployment or None}}}
+        The file holds two pickles, a {"version", "inputs"} header and then the deployments, so the header is checked before
+        any InferenceDeployment is unpickled
+    """
+    inputs = {str(p): file_sha256(p) for p in MANIFEST_INPUTS}
+    manifest = {"inputs": inputs, "deployments": {}}
+    try:
+        with open(MANIFEST_FILE, "rb") as f:
+            header = pickle.load(f)
+            if header != {"version": MANIFEST_VERSION, "inputs": inputs}:
+                print("Inputs or manifest version changed since the last build, rebuilding all deployments")
+                return manifest
+            deployments = pickle.load(f)
+    except FileNotFoundError:
+        return manifest
+    except Exception as e:
+        print(f"Could not read {MANIFEST_FILE.name}, rebuilding all deployments: {e}")
+        return manifest
+    manifest["deployments"] = deployments
+    return manifest
+
 
+def save_manifest(manifest: Dict):
+    """Write the manifest atomically, in the format read by load_manifest"""
+    fd, tmp_file = tempfile.mkstemp(dir=MANIFEST_FILE.parent, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        pickle.dump({"version": MANIFEST_VERSION, "inputs": manifest["inputs"]}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(manifest["deployments"], f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, MANIFEST_FILE)
+
+
+def load_deployments(active_deployments, incremental: bool = False, deployments_dir: Path = None):
+    """
+        Parse the active deployment files into InferenceDeployments, keyed by deployment name (file stem)
+        Deployment files are read from deployments_dir, the prod deployments by default
+        In incremental mode, deployments whose file hasn't changed since the last incremental build are reused from the manifest
+        (incremental builds are only meant for the prod deployments, the manifest is keyed by file name)
+    """
+    deployments_dir = deployments_dir or CLOUD_PROD_DEPLOYMENTS
+    deployment_configs = [deployments_dir / f for f in os.listdir(deployments_dir)]
+    previous = load_manifest()["deployments"] if incremental else {}
+    manifest = {"inputs": {str(p): file_sha256(p) for p in MANIFEST_INPUTS}, "deployments": {}} if incremental else None
+
+    active_configs, entries = [], {}
+    for config in deployment_configs:
+        sha256 = file_sha256(config) if incremental else None
+        entry = previous.get(config.name)
+        if entry is None or entry["sha256"] != sha256:
+            # Only parse active deployments, checking the name is much cheaper than parsing the whole file
+            name = read_deployment_name(config)
+            if name is None:
+                name = load_yaml(config)["metadata"]["name"]
+            entry = {"sha256": sha256, "name": name, "deployment": None}
+        entries[config.name] = entry
+        if entry["name"] in active_deployments:
+            active_configs.append(config)
+
+    to_parse = [config for config in active_configs if entries[config.name]["deployment"] is None]
+    if incremental:
+        print(f"Reusing {len(active_configs) - len(to_parse)} unchanged deployments, parsing {len(to_parse)}")
+        for config in active_configs:
+            METRICS.cache("deployment_manifest", "miss" if config in to_parse else "hit")
+
+    deployments = parse_deployments(to_parse)
+    for config, deployment in zip(to_parse, deployments):
+        entries[config.name]["deployment"] = deployment
+
+    if incremental:
+        manifest["deployments"] = entries
+        save_manifest(manifest)
+
+    # Same order as deployment_configs, so the configs are merged in the same order regardless of the number of workers
+    inference_deployments = {}
+    for config in active_configs:
+        inference_deployments[config.stem] = entries[config.name]["deployment"]
+
+    return inference_deployments
+
+def get_active_deployments(environment: str = "production") -> set:
+    """Return the names of the inference deployments running on any of the environment's clusters"""
     active_deployments = set()
-    for cluster_file in SN_IAC_PROD_CLUSTER_FILES:
-        with open(cluster_file) as f:
-            coe_values = read_coe_values_from_cluster_spec(f)
-        cluster_deployments = [d["name"] for d in coe_values['inferenceDeploymentSpecs']]
+    for cluster_deployments in get_cluster_deployments(get_cluster_files(environment)).values():
         active_deployments = active_deployments.union(cluster_deployments)
         
     return active_deployments
 
 
 def get_cloud_configs(inference_deployments):
+    """
+        Merge the cloud configs of the deployments by key
+        The deployments are left untouched, so the same parsed deployments can be merged again in other combinations
+    """
     cloud_configs = {}
     for deployment_name, inference_deployment in inference_deployments.items():
         spec = inference_deployment.spec
@@ -64,19 +195,20 @@ def get_cloud_configs(inference_deployments):
             if key in cloud_configs:
                 cloud_configs[key].merge(config)
             else:
-                cloud_configs[key] = config
+                cloud_configs[key] = config.copy()
     return cloud_configs
 
 
 def write_inventory(configs: Dict[InventoryKey, CloudConfig]):
+    """Write the cloud inventory csv, and the same rows with typed values to the JSON-Lines file next to it"""
+    sorted_keys = sorted(configs.keys(), key=lambda x: str(x))
+    records = [record for record in (configs[key].to_record() for key in sorted_keys) if record is not None]
     with open(OUTPUT_FILE, "w") as f:
         writer = csv.DictWriter(f, fieldnames=CloudConfig.fieldnames, quoting=csv.QUOTE_MINIMAL)
         writer.writeheader()
-        sorted_keys = sorted(configs.keys(), key=lambda x: str(x))
-        for key in sorted_keys:
-            row = configs[key].to_row()
-            if row is not None:
-                writer.writerow(row)
+        for record in records:
+            writer.writerow(CloudConfig.format_row(record))
+    write_jsonl(jsonl_path(OUTPUT_FILE), records, CloudConfig.fieldnames)
 
 
 def write_inventory_gtm(configs: Dict[InventoryKey, CloudConfig]):
@@ -92,8 +224,19 @@ def write_inventory_gtm(configs: Dict[InventoryKey, CloudConfig]):
 
 
 if __name__ == "__main__":
-    active_deployments = get_active_deployments()
-    deployments = load_deployments(active_deployments)
-    configs = get_cloud_configs(deployments)
-    write_inventory(configs)
-    write_inventory_gtm(configs)
+    parser = argparse.ArgumentParser(description="Build the cloud inventory from the prod inference deployments")
+    parser.add_argument("--incremental", action="store_true", help=f"Only re-parse deployments that changed since the last incremental build (state is kept in {MANIFEST_FILE.name})")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure(args)
+
+    with METRICS.span("load"):
+        active_deployments = get_active_deployments()
+    with METRICS.span("parse"):
+        deployments = load_deployments(active_deployments, incremental=args.incremental)
+    with METRICS.span("merge"):
+        configs = get_cloud_configs(deployments)
+    with METRICS.span("write"):
+        write_inventory(configs)
+        write_inventory_gtm(configs)
+    metrics.finish(args)
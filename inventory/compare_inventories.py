@@ -1,41 +1,197 @@
+import argparse
 import csv
+import hashlib
 import json
-from typing import Dict, Set, List, Tuple, Union
+import os
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Set, List, Tuple, Union
 
-from utils import STUDIO_INVENTORY_PATH, convert_seq_len, replace_af_prefix, read_csv
-from schemas import InventoryKey
-from compare_pefs import compare_pefs
-from cloud_inventory import OUTPUT_FILE as CLOUD_INVENTORY_PATH
-from compare_models import compare_models
+from utils import STUDIO_INVENTORY_PATH, CLOUD_INVENTORY_PATH, AF_REPO, convert_seq_len, replace_af_prefix, jsonl_path, write_jsonl
+from schemas import InventoryKey, CloudConfig, _to_bool
+from compare_pefs import compare_pefs, get_pef_pairs, get_studio_pef_folder, prefetch_gcs_pef_metadata, cache_af_pef_metadata, check_cache, get_cache_entry, is_stale, MAX_WORKERS
+from compare_models import compare_models, get_cloud_model_paths, cache_af_manifests, _is_fresh, MANIFEST_CACHE, MODEL_COMPARISON_FIELDS
+from artifactory import split_by_folder
+from storage import get_backend
+from metadata_cache import MetadataCache, CacheEntry
+import metrics
+from metrics import METRICS, log
 
 CLOUD_ONLY_OUTPUT="output/cloud_only_inventory.csv"
 STUDIO_ONLY_OUTPUT="output/studio_only_inventory.csv"
 COMMON_OUTPUT="output/common_inventory.csv"
 ONBOARD_TO_STUDIO_OUTPUT="output/onboard_to_studio.csv"
 MODEL_COMPARISON_OUTPUT="output/model_comparison.csv"
+DELTA_REPORT_OUTPUT="output/delta_report.csv"
 
-def get_inventories() -> Tuple[Dict[InventoryKey, Dict], Dict[InventoryKey, Dict]]:
-    """Parse the inventory files and return maps of key (tuple) -> row (dict)"""
+# str(InventoryKey) -> PEF comparison results of a common key, with the fingerprint of their inputs as validator
+# Keys whose fingerprint is unchanged reuse the stored results instead of comparing their PEFs again
+COMPARISON_CACHE_DB_FILE = Path(__file__).parent / ".comparison_cache.sqlite"
+COMPARISON_CACHE = MetadataCache(COMPARISON_CACHE_DB_FILE)
+# The outputs of the last write(), output name -> row id -> {field: csv value}, to report what changed since
+DELTA_STATE_FILE = Path(__file__).parent / ".delta_state.json"
+DELTA_REPORT_FIELDS = ["output", "id", "change", "changed_fields"]
 
-    def studio_filter(row):
-        """Only consider rows in Studio inventory that meet these criteria"""
-        return row["mode"] == "infer" and  \
-        row["rdu_arch"] == "sn40-16" and \
-        int(row["model_parallel_rdus"]) == 16 and \
-        row["model_app_name"].endswith("Experts")
-    
-    cloud_inventory, studio_inventory = {}, {}
+# Fields copied from the studio inventory are csv strings, they are parsed for the typed JSON-Lines outputs (see utils.write_jsonl)
+STUDIO_FIELD_PARSERS = {
+    "max_seq_length": int,
+    "spec_decoding": _to_bool,
+    "batch_sizes": json.loads,
+    "studio_batch_sizes": json.loads,
+    "vocab_size": int,
+}
+
+def to_typed_row(row: Dict) -> Dict:
+    """Return a copy of an output row with the studio csv strings parsed, empty strings become None"""
+    typed = dict(row)
+    for field, parse in STUDIO_FIELD_PARSERS.items():
+        value = typed.get(field)
+        if isinstance(value, str):
+            typed[field] = parse(value) if value != "" else None
+    return typed
+
+def get_cloud_inventory(cloud_configs: Dict[InventoryKey, CloudConfig] = None) -> Dict[InventoryKey, Dict]:
+    """
+        Return a map of key -> typed cloud inventory record (see CloudConfig.to_record), in cloud inventory csv order
+        Built straight from cloud_configs if given, otherwise read back from the cloud inventory csv
+    """
+    cloud_inventory = {}
+    if cloud_configs is not None:
+        for key in sorted(cloud_configs, key=str):
+            record = cloud_configs[key].to_record()
+            if record is not None:
+                cloud_inventory[key] = record
+        return cloud_inventory
 
-    with open(STUDIO_INVENTORY_PATH) as f:
-        reader = csv.DictReader(f)
-        for row in filter(studio_filter, reader):
-            studio_inventory[InventoryKey.from_input(row)] = row
     with open(CLOUD_INVENTORY_PATH) as f:
         reader = csv.DictReader(f)
+        to_key = InventoryKey.row_factory(reader.fieldnames)
         for row in reader:
-            cloud_inventory[InventoryKey.from_input(row)] = row
+            cloud_inventory[to_key(row)] = CloudConfig.parse_row(row)
+    return cloud_inventory
+
+# Columns of the studio inventory kept by read_studio_inventory, besides the InventoryKey fields
+# A studio column that should be compared or copied to the outputs has to be listed here
+STUDIO_COLUMNS = ["model_app_name", "max_seq_length", "spec_decoding", "batch_sizes", "pef_path", "model_path", "model_checkpoint_name", "vocab_size"]
+
+def read_studio_inventory() -> Tuple[Dict[InventoryKey, Dict], Dict[str, str]]:
+    """
+        Read the studio inventory in a single streaming pass and return:
+            key -> row, for the rows that meet the criteria below, with only the STUDIO_COLUMNS and key columns
+            model_checkpoint_name -> model_path, for every row (see compare_models)
+        Rows that don't meet the criteria are never turned into dicts
+    """
+    studio_inventory, model_paths = {}, {}
+
+    with open(STUDIO_INVENTORY_PATH) as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        to_key = InventoryKey.row_factory(header)
+        keep = set(STUDIO_COLUMNS) | set(InventoryKey.resolve_aliases(header).values())
+        columns = [(name, i) for i, name in enumerate(header) if name in keep]
+        mode, rdu_arch, model_parallel_rdus, model_app_name, model_checkpoint_name, model_path = (
+            header.index(name) for name in ["mode", "rdu_arch", "model_parallel_rdus", "model_app_name", "model_checkpoint_name", "model_path"]
+        )
+        for values in reader:
+            # Blank lines, skipped like csv.DictReader does
+            if not values:
+                continue
+            model_paths[values[model_checkpoint_name]] = values[model_path]
+            # Only consider rows in Studio inventory that meet these criteria
+            if values[mode] == "infer" and \
+                values[rdu_arch] == "sn40-16" and \
+                int(values[model_parallel_rdus]) == 16 and \
+                values[model_app_name].endswith("Experts"):
+                row = {name: values[i] for name, i in columns}
+                studio_inventory[to_key(row)] = row
+
+    return studio_inventory, model_paths
+
+def get_inventories(cloud_configs: Dict[InventoryKey, CloudConfig] = None) -> Tuple[Dict[InventoryKey, Dict], Dict[InventoryKey, Dict]]:
+    """Parse the inventory files and return maps of key (tuple) -> row (dict). The cloud rows are typed, see get_cloud_inventory"""
+    studio_inventory, _ = read_studio_inventory()
+    return get_cloud_inventory(cloud_configs), studio_inventory
+
+def prefetch_artifactory(studio_rows: Iterable[Dict]):
+    """
+        Look up every artifactory pef_path and model_path of the studio rows with a single search,
+        then cache the per batch size PEF metadata and the per model hash manifests
+    """
+    pef_folders, bs_folders, model_folders = set(), set(), set()
+    for studio_row in studio_rows:
+        row_bs_folders = [get_studio_pef_folder(studio_row["pef_path"], bs) for bs in json.loads(studio_row["batch_sizes"])]
+        # Folders already in the PEF metadata cache don't need to be searched again
+        if any(f.startswith(AF_REPO) and check_cache(f) is None for f in row_bs_folders):
+            pef_folders.add(replace_af_prefix(studio_row["pef_path"]))
+            bs_folders.update(row_bs_folders)
+        model_folder = replace_af_prefix(studio_row["model_path"])
+        # Manifests already validated in this run don't need to be searched again either (see watch.py)
+        if model_folder.startswith(AF_REPO) and model_folder not in model_folders:
+            entry = MANIFEST_CACHE.get_entry(model_folder)
+            if entry is None or not _is_fresh(entry):
+                model_folders.add(model_folder)
+
+    files = get_backend(AF_REPO).bulk_list(pef_folders | model_folders)
+    cache_af_pef_metadata(split_by_folder(files, bs_folders))
+    cache_af_manifests(split_by_folder(files, model_folders))
+
+def comparison_fingerprint(cloud_row: Dict, studio_row: Dict, pef_entries: Dict[str, CacheEntry]) -> str:
+    """
+        Fingerprint of everything InventoryComparer._compare_rows reads for a common key: the fields of its cloud and studio rows,
+        and the cached metadata (md5, upload date, storage validator) of every PEF it compares, see InventoryComparer._cached_pef_entries
+    """
+    inputs = {
+        "cloud_batch_sizes": cloud_row["batch_sizes"],
+        "cloud_pefs": cloud_row["cloud_pefs_json"],
+        "studio_batch_sizes": studio_row["batch_sizes"],
+        "studio_pef": studio_row["pef_path"],
+        "pefs": {path: entry.metadata for path, entry in pef_entries.items()},
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
 
-    return cloud_inventory, studio_inventory
+def _row_id(row: Dict) -> str:
+    # model comparison rows don't have 'id' column, all others do
+    return row["id"] if "id" in row else row["cloud_model_name"]
+
+def _csv_values(row: Dict, fields: List[str]) -> Dict[str, str]:
+    """The values of row as they are written to (and read back from) the csv outputs"""
+    row = CloudConfig.format_row(row)
+    return {field: "" if row.get(field) is None else str(row[field]) for field in fields}
+
+def delta_rows(output: str, previous: Dict[str, Dict[str, str]], current: Dict[str, Dict[str, str]]) -> List[Dict]:
+    """Return a delta report row for every row id of an output that was added, removed or changed between previous and current"""
+    rows = []
+    for row_id in sorted(previous.keys() | current.keys()):
+        if row_id not in previous:
+            rows.append({"output": output, "id": row_id, "change": "added", "changed_fields": []})
+        elif row_id not in current:
+            rows.append({"output": output, "id": row_id, "change": "removed", "changed_fields": []})
+        elif previous[row_id] != current[row_id]:
+            changed = sorted(f for f in previous[row_id].keys() | current[row_id].keys() if previous[row_id].get(f) != current[row_id].get(f))
+            rows.append({"output": output, "id": row_id, "change": "changed", "changed_fields": changed})
+    return rows
+
+def load_delta_state() -> Dict[str, Dict[str, Dict[str, str]]]:
+    try:
+        with open(DELTA_STATE_FILE) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_delta_state(state: Dict[str, Dict[str, Dict[str, str]]]):
+    """Write the state atomically"""
+    fd, tmp_file = tempfile.mkstemp(dir=DELTA_STATE_FILE.parent, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_file, DELTA_STATE_FILE)
+
+def index_by_group_id(inventory: Dict[InventoryKey, Dict]) -> Dict[str, List[Tuple[InventoryKey, Dict]]]:
+    """Return a map of group_id -> (key, row) for every row in inventory sharing that group_id, in inventory order"""
+    index = {}
+    for key, row in inventory.items():
+        index.setdefault(key.group_id, []).append((key, row))
+    return index
 
 class InventoryComparer():
     studio_only_fields = [
@@ -74,23 +230,33 @@ class InventoryComparer():
         "onboard_cloud_models",
         "is_new_config",
     ]
-    model_comparison_fields = [
-        'cloud_model_name',
-        'studio_model_name',
-        'cloud_path',
-        'studio_path',
-        'is_same',
-        'differing_files',
-        'cloud_only_files',
-        'studio_only_files'
-    ]
+    model_comparison_fields = MODEL_COMPARISON_FIELDS
 
-    def __init__(self):
-        self.cloud_inventory, self.studio_inventory = get_inventories()
-        self.common_keys, self.cloud_only_keys, self.studio_only_keys = self._compare_inventory_keys()
-        # raw rows from cloud and studio inventories
-        self.cloud_inventory_raw = read_csv(CLOUD_INVENTORY_PATH)
-        self.studio_inventory_raw = read_csv(STUDIO_INVENTORY_PATH)
+    def __init__(self, cloud_configs: Dict[InventoryKey, CloudConfig] = None, studio: Tuple[Dict[InventoryKey, Dict], Dict[str, str]] = None,
+                 model_comparison: List[Dict] = None):
+        """
+            Compare the studio inventory with the cloud inventory csv, or with cloud_configs (see cloud_inventory.get_cloud_configs)
+            if given, which skips writing and re-parsing the csv
+            Long-running callers (see watch.py) can pass on what they kept from earlier comparisons:
+                studio              the result of read_studio_inventory(), already prefetched with prefetch_artifactory()
+                model_comparison    model comparison rows, reused for the model pairs whose paths are unchanged
+        """
+        with METRICS.span("load"):
+            self.cloud_inventory = get_cloud_inventory(cloud_configs)
+            # The studio inventory only needs to be prefetched if it is read here
+            self._studio_prefetched = studio is not None
+            # model name -> path for every studio row, including the ones that aren't compared
+            self.studio_inventory, self.studio_model_paths = studio if studio is not None else read_studio_inventory()
+            self.common_keys, self.cloud_only_keys, self.studio_only_keys = self._compare_inventory_keys()
+            # group_id -> studio rows, for finding sibling artifacts
+            self.studio_groups = index_by_group_id(self.studio_inventory)
+        # Rows for every output, computed once by compare()
+        self._results = None
+        self._previous_model_comparison = model_comparison
+        # Common key -> stored comparison results reused by _common_row, see _reusable_comparisons
+        self._reused_comparisons = {}
+        # Rows added, removed or changed since the previous run, set by write()
+        self.delta = None
 
 
     def _compare_inventory_keys(self) -> Tuple[Set, Set, Set]:
@@ -105,32 +271,95 @@ class InventoryComparer():
         return common, cloud_only, studio_only
     
 
+    def compare(self) -> Dict[str, List[Dict]]:
+        """
+            Run the comparison and return the rows for every output, keyed by output name
+            Each row is computed exactly once, the results are reused by every writer and later calls
+        """
+        if self._results is None:
+            with METRICS.span("compare"):
+                if not self._studio_prefetched:
+                    with METRICS.span("compare/prefetch_artifactory"):
+                        self._prefetch_artifactory()
+                with METRICS.span("compare/cloud_only"):
+                    cloud_only_rows = self._cloud_only_rows()
+                with METRICS.span("compare/common"):
+                    common_rows = self._common_rows()
+                with METRICS.span("compare/studio_only"):
+                    studio_only_rows = self._studio_only_rows()
+                with METRICS.span("compare/models"):
+                    # Rows are streamed to the output as they finish, write() rewrites the file sorted
+                    model_comparison_rows = compare_models(get_cloud_model_paths(self.cloud_inventory.values()), self.studio_model_paths,
+                                                           stream_to=MODEL_COMPARISON_OUTPUT, previous=self._previous_model_comparison)
+                self._results = {
+                    "cloud_only": cloud_only_rows,
+                    "common": common_rows,
+                    "studio_only": studio_only_rows,
+                    "onboard_to_studio": self._onboard_to_studio_rows(common_rows, cloud_only_rows),
+                    "model_comparison": model_comparison_rows,
+                }
+        return self._results
+
+
+    def outputs(self) -> List[Tuple[str, List[str], str]]:
+        """Return the (output name, fields, csv file) of every output written by write()"""
+        return [
+            ("cloud_only", InventoryComparer.cloud_only_fields, CLOUD_ONLY_OUTPUT),
+            ("common", InventoryComparer.common_fields, COMMON_OUTPUT),
+            ("studio_only", InventoryComparer.studio_only_fields, STUDIO_ONLY_OUTPUT),
+            ("onboard_to_studio", InventoryComparer.onboard_to_studio_fields, ONBOARD_TO_STUDIO_OUTPUT),
+            ("model_comparison", self.model_comparison_fields, MODEL_COMPARISON_OUTPUT),
+        ]
+
+
     def write(self):
-        InventoryComparer._write_file(self._cloud_only_rows(), InventoryComparer.cloud_only_fields, CLOUD_ONLY_OUTPUT)
-        InventoryComparer._write_file(self._common_rows(), InventoryComparer.common_fields, COMMON_OUTPUT)
-        InventoryComparer._write_file(self._studio_only_rows(), InventoryComparer.studio_only_fields, STUDIO_ONLY_OUTPUT)
-        InventoryComparer._write_file(self._onboard_to_studio_rows(), InventoryComparer.onboard_to_studio_fields, ONBOARD_TO_STUDIO_OUTPUT)
-        model_comparison_rows = compare_models(self.cloud_inventory_raw, self.studio_inventory_raw)
-        InventoryComparer._write_file(model_comparison_rows, self.model_comparison_fields, MODEL_COMPARISON_OUTPUT)
+        results = self.compare()
+        with METRICS.span("write"):
+            for name, fields, filename in self.outputs():
+                InventoryComparer._write_file(results[name], fields, filename)
+            self.delta = self._write_delta_report(results)
+
+
+    def _write_delta_report(self, results: Dict[str, List[Dict]]) -> List[Dict]:
+        """
+            Write the rows of every output that were added, removed or changed since the last write() to DELTA_REPORT_OUTPUT
+            Without a previous run to compare with, every row is reported as added
+        """
+        previous = load_delta_state()
+        state, delta = {}, []
+        for name, fields, _ in self.outputs():
+            state[name] = {_row_id(row): _csv_values(row, fields) for row in results[name]}
+            delta += delta_rows(name, previous.get(name, {}), state[name])
+        InventoryComparer._write_file(delta, DELTA_REPORT_FIELDS, DELTA_REPORT_OUTPUT, sort=False)
+        save_delta_state(state)
+        counts = {change: sum(1 for row in delta if row["change"] == change) for change in ["added", "removed", "changed"]}
+        print(f"Since the last run: {counts['added']} rows added, {counts['removed']} removed, {counts['changed']} changed, see {DELTA_REPORT_OUTPUT}")
+        return delta
+
+
+    def _prefetch_artifactory(self):
+        prefetch_artifactory(self.studio_inventory.values())
 
 
     @staticmethod
-    def _write_file(rows, fields, filename):
-        # model comparison rows don't have 'id' column, all others do
-        rows = sorted(rows, key=lambda x: x["id"] if "id" in x else x["cloud_model_name"])
+    def _write_file(rows, fields, filename, sort: bool = True):
+        """Write the rows to the csv filename, and with typed values to the JSON-Lines file next to it"""
+        if sort:
+            rows = sorted(rows, key=_row_id)
         with open(filename, "w") as f:
             writer = csv.DictWriter(f, fieldnames=fields, quoting=csv.QUOTE_MINIMAL)
             writer.writeheader()
-            writer.writerows(rows)    
+            writer.writerows(CloudConfig.format_row(row) for row in rows)
+        write_jsonl(jsonl_path(filename), (to_typed_row(row) for row in rows), fields)
 
 
     @staticmethod
     def _compare_rows(cloud_row: Dict, studio_row: Dict) -> Dict:
-        cloud_bs, studio_bs = set(json.loads(cloud_row["batch_sizes"])), set(json.loads(studio_row["batch_sizes"]))
+        cloud_bs, studio_bs = set(cloud_row["batch_sizes"]), set(json.loads(studio_row["batch_sizes"]))
         common_bs = sorted(list(cloud_bs.intersection(studio_bs)))
         cloud_only_bs = sorted(list(cloud_bs.difference(studio_bs)))
         studio_only_bs = sorted(list(studio_bs.difference(cloud_bs)))
-        common_bs_with_matching_pefs, common_bs_different_pefs, date_difference = compare_pefs(json.loads(cloud_row["cloud_pefs_json"]), studio_row["pef_path"], common_bs)
+        common_bs_with_matching_pefs, common_bs_different_pefs, date_difference = compare_pefs(cloud_row["cloud_pefs_json"], studio_row["pef_path"], common_bs)
         return {
             "studio_only_bs": studio_only_bs,
             "cloud_only_bs": cloud_only_bs,
@@ -145,11 +374,10 @@ class InventoryComparer():
     def _find_sibling_artifacts(self, key: InventoryKey) -> Tuple[Union[Dict, None], Union[str, None]]:
         sibling_studio_pefs = {}
         studio_model = None
-        for other_key, row in self.studio_inventory.items():
-            if key.is_sibling(other_key):
-                seq_len_key = convert_seq_len(other_key.max_seq_length, str)
-                sibling_studio_pefs[seq_len_key] = row["pef_path"].replace("{{ARTIFACTS_REPO}}", "sw-generic-daas-artifacts-dev")
-                studio_model = row["model_path"].replace("{{ARTIFACTS_REPO}}", "sw-generic-daas-artifacts-dev")
+        for other_key, row in self.studio_groups.get(key.group_id, []):
+            seq_len_key = convert_seq_len(other_key.max_seq_length, str)
+            sibling_studio_pefs[seq_len_key] = row["pef_path"].replace("{{ARTIFACTS_REPO}}", "sw-generic-daas-artifacts-dev")
+            studio_model = row["model_path"].replace("{{ARTIFACTS_REPO}}", "sw-generic-daas-artifacts-dev")
         return sibling_studio_pefs if sibling_studio_pefs else None, studio_model   
 
 
@@ -184,29 +412,110 @@ class InventoryComparer():
         return rows
 
 
-    def _common_rows(self) -> List[Dict]:
-        rows = []
-        for key in self.common_keys:
-            cloud_row, studio_row = self.cloud_inventory[key], self.studio_inventory[key]
-            row = {}
-            for field in InventoryComparer.common_fields:
-                if field in studio_row:
-                    row[field] = studio_row[field]
-                if field in cloud_row:
-                    row[field] = cloud_row[field]
-                row["studio_model"] = replace_af_prefix(studio_row["model_path"])
-                row["studio_pef"] = replace_af_prefix(studio_row["pef_path"])
-                row["studio_batch_sizes"] = studio_row["batch_sizes"]
-            sibling_studio_pefs, _ = self._find_sibling_artifacts(key)
-            row["sibling_studio_pefs"] = sibling_studio_pefs 
+    def _common_row(self, key: InventoryKey) -> Dict:
+        cloud_row, studio_row = self.cloud_inventory[key], self.studio_inventory[key]
+        row = {}
+        for field in InventoryComparer.common_fields:
+            if field in studio_row:
+                row[field] = studio_row[field]
+            if field in cloud_row:
+                row[field] = cloud_row[field]
+            row["studio_model"] = replace_af_prefix(studio_row["model_path"])
+            row["studio_pef"] = replace_af_prefix(studio_row["pef_path"])
+            row["studio_batch_sizes"] = studio_row["batch_sizes"]
+        sibling_studio_pefs, _ = self._find_sibling_artifacts(key)
+        row["sibling_studio_pefs"] = sibling_studio_pefs 
+        row_comparison_results = self._reused_comparisons.get(key)
+        if row_comparison_results is None:
+            METRICS.cache("comparison", "miss")
             row_comparison_results = InventoryComparer._compare_rows(cloud_row, studio_row)
-            row.update(row_comparison_results)
-            rows.append(row)
+            # Stored with the PEF metadata it was computed from, all of which is cached by now
+            pef_entries = self._cached_pef_entries(key)
+            if pef_entries is not None:
+                fingerprint = comparison_fingerprint(cloud_row, studio_row, pef_entries)
+                COMPARISON_CACHE.put(str(key), InventoryComparer._encode_comparison(row_comparison_results), {"fingerprint": fingerprint})
+        else:
+            METRICS.cache("comparison", "hit")
+        row.update(row_comparison_results)
+        return row
+
+
+    @staticmethod
+    def _encode_comparison(comparison: Dict) -> Dict:
+        """The comparison results of _compare_rows as stored in COMPARISON_CACHE, json would turn the int batch size keys into strings"""
+        return dict(comparison, date_difference_for_nonmatching_pefs=list(comparison["date_difference_for_nonmatching_pefs"].items()))
+
+
+    @staticmethod
+    def _decode_comparison(stored: Dict) -> Dict:
+        return dict(stored, date_difference_for_nonmatching_pefs={bs: days for bs, days in stored["date_difference_for_nonmatching_pefs"]})
+
+
+    def _pef_pairs(self, key: InventoryKey) -> List[Tuple[str, str]]:
+        """Return the (cloud_pef, studio_pef) paths compared for a common key"""
+        cloud_row, studio_row = self.cloud_inventory[key], self.studio_inventory[key]
+        common_bs = sorted(set(cloud_row["batch_sizes"]).intersection(json.loads(studio_row["batch_sizes"])))
+        return get_pef_pairs(cloud_row["cloud_pefs_json"], studio_row["pef_path"], common_bs)
+
+
+    def _cached_pef_entries(self, key: InventoryKey) -> Union[Dict[str, CacheEntry], None]:
+        """Return path -> PEF metadata cache entry for every PEF compared for a key, or None if any of them isn't cached"""
+        entries = {}
+        for pair in self._pef_pairs(key):
+            for path in pair:
+                entries[path] = get_cache_entry(path)
+                if entries[path] is None:
+                    return None
+        return entries
+
+
+    def _reusable_comparisons(self, keys: List[InventoryKey]) -> Dict[InventoryKey, Dict]:
+        """
+            Return the stored comparison results of the keys whose inputs have the same fingerprint as when they were compared,
+            including the cached metadata of every PEF they compared
+            A key is compared again if any of its PEFs is no longer in the PEF metadata cache (e.g. the cache was deleted),
+            needs to be revalidated (see compare_pefs.CACHE_TTL), or was revalidated since the comparison was stored
+        """
+        reused = {}
+        for key in keys:
+            entry = COMPARISON_CACHE.get_entry(str(key))
+            pef_entries = self._cached_pef_entries(key)
+            if entry is None or pef_entries is None:
+                continue
+            if entry.validator != {"fingerprint": comparison_fingerprint(self.cloud_inventory[key], self.studio_inventory[key], pef_entries)}:
+                continue
+            # Entries migrated from the YAML cache have no validation time, they predate every stored comparison
+            if any(is_stale(path, pef_entry) or (pef_entry.validated_at or 0) > entry.validated_at
+                   for path, pef_entry in pef_entries.items()):
+                continue
+            reused[key] = InventoryComparer._decode_comparison(entry.metadata)
+        return reused
+
+
+    def _prefetch_pef_metadata(self, keys: List[InventoryKey]):
+        """Fill the PEF metadata cache for every PEF compared by the keys, listing shared GCS prefixes in bulk"""
+        pef_paths = []
+        for key in keys:
+            for cloud_pef, studio_pef in self._pef_pairs(key):
+                pef_paths += [cloud_pef, studio_pef]
+        prefetch_gcs_pef_metadata(pef_paths)
+
+
+    def _common_rows(self) -> List[Dict]:
+        keys = sorted(self.common_keys, key=str)
+        # Keys whose inputs haven't changed reuse their previous results, only the others are compared
+        self._reused_comparisons = self._reusable_comparisons(keys)
+        log(f"Reusing the comparisons of {len(self._reused_comparisons)} unchanged common keys, comparing {len(keys) - len(self._reused_comparisons)}")
+        with METRICS.span("compare/prefetch_pef_metadata"):
+            self._prefetch_pef_metadata([key for key in keys if key not in self._reused_comparisons])
+        # Rows are compared concurrently, the PEF metadata lookups for each row are the slow part
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="common-rows") as executor:
+            rows = list(executor.map(self._common_row, keys))
         
         return rows
 
 
-    def _onboard_to_studio_rows(self) -> List[Dict]:
+    def _onboard_to_studio_rows(self, common_rows: List[Dict], cloud_only_rows: List[Dict]) -> List[Dict]:
         def _build_row(input_row: Dict, is_new_config: bool) -> Dict:
             row = {}
             for field in InventoryComparer.onboard_to_studio_fields:
@@ -217,7 +526,6 @@ class InventoryComparer():
             return row
         
         rows = []
-        common_rows, cloud_only_rows = self._common_rows(), self._cloud_only_rows()
         for common_row in common_rows:
             # Only need to onboard rows in common where there are cloud-only BS PEFs or different PEFs for same BS
             if common_row["cloud_only_bs"] == [] and common_row["common_bs_different_pefs"] == []:
@@ -230,5 +538,11 @@ class InventoryComparer():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the cloud and studio inventories and write the results to output/")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure(args)
+
     ic = InventoryComparer()
     ic.write()
+    metrics.finish(args)
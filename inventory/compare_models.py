@@ -1,25 +1,35 @@
-from typing import Dict, List
-import subprocess
-import json
+from typing import Dict, Iterable, List, Union
+from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+import os
+import threading
+import time
 import csv
-import base64
-import yaml
+import hashlib
 
-from utils import replace_af_prefix, read_csv, STUDIO_INVENTORY_PATH
-from cloud_inventory import OUTPUT_FILE as CLOUD_INVENTORY_PATH
+from utils import replace_af_prefix, read_csv, load_yaml, CONFIG, STUDIO_INVENTORY_PATH, CLOUD_INVENTORY_PATH
+from metadata_cache import MetadataCache, CacheEntry
+from storage import get_backend, ObjectInfo
+from metrics import METRICS, log
     
 
 # cloud name -> studio name mappings
-with open("cloud_studio_model_mappings.yaml") as f:
-    MODEL_MAPPINGS = yaml.safe_load(f)
+MODEL_MAPPINGS_FILE = Path(__file__).parent / "cloud_studio_model_mappings.yaml"
+CONFIG.register("cloud_studio_model_mappings", lambda: load_yaml(MODEL_MAPPINGS_FILE))
 
-def _get_cloud_model_paths(cloud_inventory: List[Dict]):
-    """Given the cloud inventory, return a dict of model name -> path"""
+# checkpoint folder -> manifest {"files": {file name: {md5, size, generation or modified}}, "digest": manifest_digest(files)}
+MANIFEST_CACHE_DB_FILE = Path(__file__).parent / ".manifest_cache.sqlite"
+MANIFEST_CACHE = MetadataCache(MANIFEST_CACHE_DB_FILE)
+# Max age in seconds of a cached manifest before it is revalidated against storage
+# The default 0 revalidates every manifest once per run
+MANIFEST_CACHE_TTL = float(os.environ.get("MODEL_MANIFEST_CACHE_TTL", 0))
+RUN_STARTED = time.time()
+
+def get_cloud_model_paths(cloud_inventory: Iterable[Dict]):
+    """Given the typed cloud inventory records (see CloudConfig.to_record), return a dict of model name -> path"""
     model_paths = {}
     for row in cloud_inventory:
-        # Convert the string representation of the dictionary to an actual dictionary
-        cloud_models_dict = json.loads(row['cloud_models'].replace("'",'"'))
-        model_paths.update(cloud_models_dict)
+        model_paths.update(row['cloud_models'])
 
     return model_paths
         
@@ -46,101 +56,201 @@ def _compare_hashes(cloud_hashes, studio_hashes):
     studio_only = set(studio_hashes.keys()) - set(cloud_hashes.keys())
     return different_hashes, cloud_only, studio_only
 
+def manifest_digest(files: Dict[str, Dict]) -> str:
+    """Digest of the file names and md5sums of a manifest, two checkpoints with the same digest have the same files"""
+    digest = hashlib.sha256()
+    for file_name in sorted(files):
+        digest.update(f"{file_name}\0{files[file_name]['md5']}\n".encode())
+    return digest.hexdigest()
+
+def _manifest(files: Dict[str, Dict]) -> Dict:
+    return {"files": files, "digest": manifest_digest(files)}
+
+def _versions_digest(versions: List[str]) -> str:
+    """Digest of the '<path>#<generation or modified time>' of every file in a folder, used as the manifest validator"""
+    return hashlib.sha256("\n".join(sorted(versions)).encode()).hexdigest()
+
+def _is_fresh(entry: CacheEntry) -> bool:
+    """Check if a cached manifest was validated recently enough to be used without checking storage"""
+    return entry.validated_at is not None and entry.validated_at >= RUN_STARTED - MANIFEST_CACHE_TTL
+
 def _get_hashes_gcs(path):
-    """Get md5sums for all files under <path> using gsutil ls -L
-    gsutil ls -L output looks like this:
-    gs://acp-coe-models-checkpoints-prod-0/version/0.1.0/pefs-checkpoints/ckpts/Llama-Guard-3-8B/.gitattributes:
-        Creation time:          Thu, 14 Nov 2024 22:00:18 GMT
-        Update time:            Thu, 14 Nov 2024 22:00:18 GMT
-        Storage class:          STANDARD
-        Content-Length:         1519
-        Content-Type:           application/octet-stream
-        Metadata:               
-            goog-reserved-file-mtime:1731487159
-        Hash (crc32c):          AjbvVQ==
-        Hash (md5):             qFn4qJaFdH/9QXG4cFQMQQ==
-    <next file>
     """
-    file_hashes = {}
-    command = f"gsutil ls -L {path}"
-    result = subprocess.run(command, shell=True, capture_output=True, text=True)
-    if result.stderr:
-        raise subprocess.SubprocessError(f"Error message: {result.stderr}")
-    
-    lines = result.stdout.splitlines()
-    for line in lines:
-        line = line.strip()
-        if line.startswith("gs://"):
-            file_name = line.split('/')[-1].rstrip(':') # Just the basename
-        if line.startswith("Hash (md5):"):
-            md5sum_encoded = line.split()[-1]
-            md5sum = base64.b64decode(md5sum_encoded).hex()
-            file_hashes[file_name] = md5sum
-    return file_hashes
+        Get the manifest of all files under <path> (not recursive)
+        The cached manifest is reused if the cheap generation listing shows no file was added, removed or overwritten since
+    """
+    backend = get_backend(path)
+    entry = MANIFEST_CACHE.get_entry(path)
+    if entry is not None and _is_fresh(entry):
+        METRICS.cache("checkpoint_manifest", "hit")
+        return entry.metadata
+    if entry is not None and entry.validator is not None:
+        if entry.validator == {"generations": _versions_digest(backend.versions(path))}:
+            METRICS.cache("checkpoint_manifest", "revalidated")
+            MANIFEST_CACHE.touch(path)
+            return entry.metadata
+        print(f"Checkpoint at {path} changed since it was cached, listing it again")
+
+    METRICS.cache("checkpoint_manifest", "miss")
+    files, versions = {}, []
+    for obj in backend.list(path):
+        versions.append(f"{obj.path}#{obj.generation}")
+        # Composite objects have no md5 and can't be compared
+        if obj.md5 is None:
+            continue
+        file_name = obj.path.split('/')[-1] # Just the basename
+        files[file_name] = {"md5": obj.md5, "size": obj.size, "generation": obj.generation}
+    manifest = _manifest(files)
+    MANIFEST_CACHE.put(path, manifest, {"generations": _versions_digest(versions)})
+    return manifest
+
+def _af_manifest(files: List[ObjectInfo]) -> Dict:
+    """Given a list of artifactory files, return the manifest of those files"""
+    manifest_files = {}
+    for file_metadata in files:
+        file_name = file_metadata.path.split("/")[-1]
+        manifest_files[file_name] = {
+            "md5": file_metadata.md5,
+            "size": file_metadata.size,
+            "modified": file_metadata.modified,
+        }
+    return _manifest(manifest_files)
+
+def _af_validator(files: List[ObjectInfo]) -> Dict:
+    return {"modified": _versions_digest([f"{f.path}#{f.modified}" for f in files])}
+
+def cache_af_manifests(folder_files: Dict[str, List[ObjectInfo]]):
+    """
+        Store the manifests of artifactory folders from a bulk artifactory search (see StorageBackend.bulk_list)
+        The bulk search is a single query for all folders, so it also serves as this run's validation of the cached manifests
+    """
+    for folder, files in folder_files.items():
+        MANIFEST_CACHE.put(folder, _af_manifest(files), _af_validator(files))
 
 def _get_hashes_af(af_path):
-    """Given an artifactory folder path, return a dict of md5sums for all files under that path"""
-    hashes = {}
+    """Given an artifactory folder path, return the manifest of all files under that path"""
     af_path = replace_af_prefix(af_path)
-    command = f"jf rt s {af_path}"
+    entry = MANIFEST_CACHE.get_entry(af_path)
+    if entry is not None and _is_fresh(entry):
+        METRICS.cache("checkpoint_manifest", "hit")
+        return entry.metadata
+    METRICS.cache("checkpoint_manifest", "miss")
+    # Searching a folder is a single query that returns the md5sums, there is no cheaper check to validate the cached manifest with
+    files = get_backend(af_path).list(af_path, recursive=True)
+    manifest = _af_manifest(files)
+    MANIFEST_CACHE.put(af_path, manifest, _af_validator(files))
+    return manifest
 
-    output = subprocess.run(command, shell=True, capture_output=True, text=True)
-    assert output.returncode == 0, f"Got bad returncode for '{command}' with error {output.stderr}"
-    output = output.stdout
+# Number of model pairs compared at the same time, each pair lists both of its checkpoints concurrently
+MAX_WORKERS = int(os.environ.get("MODEL_COMPARISON_WORKERS", 8))
 
-    out_json = json.loads(output)
-    # out_json is a list of file metadata for each file in the coe_pef folder
-    for file_metadata in out_json:
-        file_name = file_metadata["path"].split("/")[-1]
-        hashes[file_name] = file_metadata["md5"]
-    
-    return hashes
+MODEL_COMPARISON_FIELDS = [
+    'cloud_model_name',
+    'studio_model_name',
+    'cloud_path',
+    'studio_path',
+    'is_same',
+    'differing_files',
+    'cloud_only_files',
+    'studio_only_files'
+]
 
-def _compare_paths(cloud_path, studio_path):
-    """Compare two folders cloud_path and studio_path for equality of all files"""
-    cloud_hashes = _get_hashes_gcs(cloud_path)
-    if studio_path.startswith("gs://"):
-        studio_hashes =  _get_hashes_gcs(studio_path)
-    else:
-        studio_hashes = _get_hashes_af(studio_path)
-    return _compare_hashes(cloud_hashes, studio_hashes)        
+_LISTING_LOCK = threading.Lock()
+# path -> Future of its manifest, so a checkpoint shared by several model pairs is only listed once
+_LISTINGS: Dict[str, Future] = {}
+_LISTING_EXECUTOR = None
 
-def compare_models(cloud_inventory, studio_inventory):
-    cloud_models = _get_cloud_model_paths(cloud_inventory)
-    studio_models = _get_studio_model_paths(studio_inventory)
+def _get_hashes(path: str) -> Future:
+    """Start getting the manifest of all files under path (GCS or artifactory) and return the Future of the result"""
+    global _LISTING_EXECUTOR
+    with _LISTING_LOCK:
+        if _LISTING_EXECUTOR is None:
+            _LISTING_EXECUTOR = ThreadPoolExecutor(max_workers=2 * MAX_WORKERS, thread_name_prefix="checkpoint-listing")
+        if path not in _LISTINGS:
+            get_hashes = _get_hashes_gcs if path.startswith("gs://") else _get_hashes_af
+            _LISTINGS[path] = _LISTING_EXECUTOR.submit(get_hashes, path)
+        return _LISTINGS[path]
 
-    rows = []
+def start_new_run():
+    """For long-running processes (see watch.py): checkpoints are listed and cached manifests revalidated again, as in a new run"""
+    global RUN_STARTED
+    with _LISTING_LOCK:
+        RUN_STARTED = time.time()
+        _LISTINGS.clear()
+
+def _compare_paths(cloud_path, studio_path):
+    """Compare two folders cloud_path and studio_path for equality of all files. Both folders are listed at the same time"""
+    cloud_manifest, studio_manifest = _get_hashes(cloud_path), _get_hashes(studio_path)
+    cloud_manifest, studio_manifest = cloud_manifest.result(), studio_manifest.result()
+    if cloud_manifest["digest"] == studio_manifest["digest"]:
+        return {}, set(), set()
+    cloud_hashes = {file_name: f["md5"] for file_name, f in cloud_manifest["files"].items()}
+    studio_hashes = {file_name: f["md5"] for file_name, f in studio_manifest["files"].items()}
+    return _compare_hashes(cloud_hashes, studio_hashes)
 
-    # In addition to the explicit mappings in MODEL_MAPPINGS, 
+def _compare_model(cloud_name, studio_name, cloud_path, studio_path) -> Dict:
+    differing_files, cloud_only, studio_only = _compare_paths(cloud_path, studio_path)
+    return {
+        'cloud_model_name': cloud_name,
+        'studio_model_name': studio_name,
+        'cloud_path': cloud_path,
+        'studio_path': studio_path,
+        'is_same': len(differing_files) == 0 and len(cloud_only) == 0 and len(studio_only) == 0,
+        'differing_files': sorted(list(differing_files.keys())),
+        'cloud_only_files': sorted(list(cloud_only)),
+        'studio_only_files': sorted(list(studio_only))
+    }
+
+def compare_models(cloud_models: Dict[str, str], studio_models: Dict[str, str], stream_to: Union[str, Path, None] = None,
+                   previous: List[Dict] = None) -> List[Dict]:
+    """
+        Compare the checkpoints of every mapped cloud/studio model pair, up to MAX_WORKERS pairs at a time
+        cloud_models and studio_models map model name -> checkpoint path, see get_cloud_model_paths and read_studio_inventory
+        If stream_to is given, each row is appended to that csv as soon as its pair finishes,
+        callers should rewrite the file sorted once all rows are in (see InventoryComparer.write)
+        previous are the rows of an earlier call, reused for the pairs whose names and paths are the same (see watch.py)
+        Rows are returned in mapping order
+    """
+    # In addition to the explicit mappings in MODEL_MAPPINGS_FILE, 
     # we also want to include models that have the same name in both inventories
+    model_mappings = dict(CONFIG.get("cloud_studio_model_mappings"))
     same_name = [m for m in cloud_models if m in studio_models]
-    MODEL_MAPPINGS.update({m:m for m in same_name})
-
-    for cloud_name, studio_name in MODEL_MAPPINGS.items():
-        cloud_path = cloud_models[cloud_name]
-        studio_path = studio_models[studio_name]
+    model_mappings.update({m:m for m in same_name})
 
+    pairs = []
+    for cloud_name, studio_name in model_mappings.items():
         # Check if the models from MODEL_MAPPINGS exist in the inventories
         if not cloud_name in cloud_models:
             raise ValueError(f"{cloud_name} not found in cloud models")
         if not studio_name in studio_models:
             raise ValueError(f"{studio_name} not found in studio models")
-        
-        differing_files, cloud_only, studio_only = _compare_paths(cloud_path, studio_path)
-        row = {
-            'cloud_model_name': cloud_name,
-            'studio_model_name': studio_name,
-            'cloud_path': cloud_path,
-            'studio_path': studio_path,
-            'is_same': len(differing_files) == 0 and len(cloud_only) == 0 and len(studio_only) == 0,
-            'differing_files': sorted(list(differing_files.keys())),
-            'cloud_only_files': sorted(list(cloud_only)),
-            'studio_only_files': sorted(list(studio_only))
-        }
-        rows.append(row)
-    return rows
+        pairs.append((cloud_name, studio_name, cloud_models[cloud_name], studio_models[studio_name]))
+
+    reused = {(row["cloud_model_name"], row["studio_model_name"], row["cloud_path"], row["studio_path"]): row for row in previous or []}
+
+    stream_file = open(stream_to, "w") if stream_to is not None else None
+    try:
+        if stream_file is not None:
+            writer = csv.DictWriter(stream_file, fieldnames=MODEL_COMPARISON_FIELDS, quoting=csv.QUOTE_MINIMAL)
+            writer.writeheader()
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="model-comparison") as executor:
+            futures = [executor.submit(_compare_model, *pair) for pair in pairs if pair not in reused]
+            if stream_file is not None:
+                writer.writerows(reused[pair] for pair in pairs if pair in reused)
+            for future in as_completed(futures):
+                row = future.result()
+                log(f"Compared {row['cloud_model_name']} and {row['studio_model_name']}: {'SAME' if row['is_same'] else 'DIFFERENT'}")
+                if stream_file is not None:
+                    writer.writerow(row)
+                    stream_file.flush()
+    finally:
+        if stream_file is not None:
+            stream_file.close()
+
+    rows = iter([future.result() for future in futures])
+    return [reused[pair] if pair in reused else next(rows) for pair in pairs]
 
 # if __name__ == "__main__":
-#     cloud_inventory = read_csv(CLOUD_INVENTORY_PATH)
-#     studio_inventory = read_csv(STUDIO_INVENTORY_PATH)
-#     compare_models(cloud_inventory, studio_inventory, "test.csv")
+#     cloud_models = get_cloud_model_paths(CloudConfig.parse_row(row) for row in read_csv(CLOUD_INVENTORY_PATH))
+#     studio_models = _get_studio_model_paths(read_csv(STUDIO_INVENTORY_PATH))
+#     compare_models(cloud_models, studio_models, "test.csv")
@@ -1,50 +1,140 @@
-import subprocess
-import json
-import yaml
-import base64
-import dateutil.parser
 from datetime import timezone
 import os
 from pathlib import Path
-import atexit
-from typing import Dict, List
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Tuple, Union
 
+from utils import replace_af_prefix, AF_REPO
+from metadata_cache import MetadataCache, CacheEntry
+from storage import get_backend, ObjectInfo, StorageError
+from metrics import METRICS, log
 
+
+# The cache used to be a YAML file written at exit, it is migrated into the SQLite cache the first time it's opened
 CACHE_FILE = Path(__file__).parent / ".md5sum_cache.yaml"
-with open(CACHE_FILE) as f:
-    CACHE = yaml.safe_load(f)
-    if CACHE is None:
-        CACHE = {}
+CACHE_DB_FILE = Path(__file__).parent / ".md5sum_cache.sqlite"
+# Every update is written to disk immediately
+CACHE = MetadataCache(CACHE_DB_FILE, migrate_from=CACHE_FILE)
+
+def _ttl_from_env(var: str):
+    val = os.environ.get(var)
+    return float(val) if val else None
+
+# Max age in seconds of a cache entry before it is revalidated against storage, per storage backend
+# Unset means entries never expire, 0 revalidates every entry once per run
+CACHE_TTL = {
+    "gs://": _ttl_from_env("PEF_CACHE_TTL_GCS"),
+    AF_REPO: _ttl_from_env("PEF_CACHE_TTL_AF"),
+}
+# Entries validated during this run are never revalidated again in the same run
+RUN_STARTED = time.time()
+
+# Number of metadata lookups (see storage.get_backend) allowed to run at the same time
+MAX_WORKERS = int(os.environ.get("PEF_METADATA_WORKERS", 16))
+# Minimum number of uncached PEFs sharing a GCS prefix before the prefix is listed in one go instead of stat'ed per PEF
+PREFIX_LISTING_MIN_PATHS = int(os.environ.get("PEF_PREFIX_LISTING_MIN_PATHS", 2))
+
+_CACHE_LOCK = threading.Lock()
+# path -> number of times its metadata was requested / fetched from storage in this run
+LOOKUP_COUNTS = Counter()
+FETCH_COUNTS = Counter()
+# path -> Future for lookups that are currently running, so duplicate requests wait on the same fetch
+_IN_FLIGHT: Dict[str, Future] = {}
+_EXECUTOR = None
 
-def write_cache():
-    print("Writing cache...", end=" ")
-    with open(CACHE_FILE, "w") as f:
-        yaml.dump(CACHE, f)
-    print("done")
+def get_executor() -> ThreadPoolExecutor:
+    """Return the shared thread pool used for metadata lookups, creating it on first use"""
+    global _EXECUTOR
+    with _CACHE_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="pef-metadata")
+    return _EXECUTOR
 
-# Write the updated cache before exiting
-atexit.register(write_cache)
+def start_new_run():
+    """For long-running processes (see watch.py): cached metadata is revalidated again according to CACHE_TTL, as in a new run"""
+    global RUN_STARTED
+    RUN_STARTED = time.time()
+
+def is_stale(path: str, entry: CacheEntry) -> bool:
+    """Check if a cache entry is older than the TTL of its storage backend and needs to be revalidated"""
+    for prefix, ttl in CACHE_TTL.items():
+        if path.startswith(prefix) and ttl is not None:
+            return entry.validated_at is None or entry.validated_at < RUN_STARTED - ttl
+    return False
+
+def get_cache_entry(path: str) -> Union[CacheEntry, None]:
+    """Return the PEF metadata cache entry for path, stale or not, or None if it isn't cached"""
+    return CACHE.get_entry(path)
+
+def check_cache(path: str):
+    """Return the cached metadata for path, or None if it isn't cached or needs to be revalidated"""
+    entry = CACHE.get_entry(path)
+    if entry is None or is_stale(path, entry):
+        return None
+    return entry.metadata
+
+def update_cache(path: str, metadata: Dict) -> Dict:
+    """
+        Cache freshly fetched metadata for path and return it without its validator
+        If the cached entry has the same validator (GCS generation / artifactory modified time and sha256),
+        the PEF hasn't changed and the entry is only marked as validated
+    """
+    metadata = dict(metadata)
+    validator = metadata.pop("validator", None)
+    entry = CACHE.get_entry(path)
+    if entry is not None and validator is not None and entry.validator == validator:
+        CACHE.touch(path)
+        return entry.metadata
+    if entry is not None and entry.metadata != metadata:
+        print(f"PEF at {path} changed since it was cached, updating cache")
+    CACHE.put(path, metadata, validator)
+    return metadata
 
 def cache_metadata(fn):
     """
         Decorator for caching PEF metadata to speed up metadata retrieval
-        Checks cache for metadata, then if cache miss runs retrieval function and caches the result
+        Checks cache for metadata, then if cache miss (or the entry is stale) runs retrieval function and caches the result
+        Safe to call from multiple threads: concurrent lookups of the same path share a single fetch
     """
-    def check_cache(path: str):
-        return CACHE.get(path, None)
+    def wrapper(pef_path: str):
+        with _CACHE_LOCK:
+            LOOKUP_COUNTS[pef_path] += 1
+            cached_val = check_cache(pef_path)
+            if cached_val is not None:
+                METRICS.cache("pef_metadata", "hit")
+                log(f"Checking cache for {pef_path}... HIT")
+                return cached_val
+            in_flight = _IN_FLIGHT.get(pef_path)
+            if in_flight is None:
+                in_flight = _IN_FLIGHT[pef_path] = Future()
+                is_owner = True
+            else:
+                is_owner = False
 
-    def update_cache(path: str, metadata: Dict):
-        CACHE[path] = metadata
+        # Another thread is already fetching this path, wait for its result
+        if not is_owner:
+            METRICS.cache("pef_metadata", "in_flight")
+            log(f"Checking cache for {pef_path}... IN FLIGHT")
+            return in_flight.result()
 
-    def wrapper(pef_path: str):
-        print(f"Checking cache for {pef_path}...", end=" ")
-        cached_val = check_cache(pef_path)
-        if cached_val is not None:
-            print("HIT")
-            return cached_val
-        print("MISS")
-        metadata = fn(pef_path)
-        update_cache(pef_path, metadata)
+        METRICS.cache("pef_metadata", "miss")
+        log(f"Checking cache for {pef_path}... MISS")
+        with _CACHE_LOCK:
+            FETCH_COUNTS[pef_path] += 1
+        try:
+            metadata = fn(pef_path)
+        except BaseException as e:
+            with _CACHE_LOCK:
+                del _IN_FLIGHT[pef_path]
+            in_flight.set_exception(e)
+            raise
+        with _CACHE_LOCK:
+            metadata = update_cache(pef_path, metadata)
+            del _IN_FLIGHT[pef_path]
+        in_flight.set_result(metadata)
         return metadata
 
     return wrapper
@@ -52,20 +142,13 @@ def cache_metadata(fn):
 @cache_metadata
 def get_studio_pef_metadata(pef_path: str):
     """Get the pef metadata for the Studio PEF. Input is the folder path containing the PEF."""
-    if pef_path.startswith('sw-generic-daas-artifacts-dev'):
-        return _get_jf_pef_metadata(pef_path)
+    if pef_path.startswith(AF_REPO):
+        return _get_af_pef_metadata(pef_path)
     elif pef_path.startswith('gs://'):
-        result = subprocess.run(['gsutil', 'ls', pef_path], capture_output=True, text=True)
-        if result.returncode != 0:
-            raise RuntimeError(f"Failed to list GCS path {pef_path}: {result.stderr}")
-        pef_line = None
-        for line in result.stdout.splitlines():
-            if line.endswith('.pef'):
-                pef_line = line
-                break
-        if pef_line is None:
+        pefs = get_backend(pef_path).list(pef_path, suffix=".pef")
+        if not pefs:
             raise FileNotFoundError(f"No .pef file found in {pef_path}")
-        return _get_gcs_pef_metadata(pef_line)
+        return _gcs_pef_metadata(pefs[0])
 
 
 @cache_metadata
@@ -74,86 +157,117 @@ def get_cloud_pef_metadata(pef_path: str):
     return _get_gcs_pef_metadata(pef_path)
     
 
-def _get_jf_pef_metadata(pef_path: str):
+def _get_af_pef_metadata(pef_path: str):
     """
-        Retrieve pef metadata from JFrog.
-        Parses the data from the output of jf rt s <pef_path>. See below comment for an example of output
+        Retrieve pef metadata from artifactory.
         Input: folder path containing the PEF file
     """
-    # [
-    #   {
-    #     "path": "sw-generic-daas-artifacts-dev/inference-engine/2025/pefs/deepseek-r1-16k-fp8-pef-v3/bs1/coe_pef/sncprof.json.gz",
-    #     "type": "file",
-    #     "size": 11590862,
-    #     "created": "2025-03-26T13:53:39.342-07:00",
-    #     "modified": "2025-03-26T13:53:39.221-07:00",
-    #     "sha1": "676cc424ff69a54a2bea4135176085ae275250da",
-    #     "sha256": "c64a33338be0b6bc5219b387ae76998f8d8017d99b01823b1a6e16e0a9928868",
-    #     "md5": "a2334cef8b358cc35f3b96b30b13509e"
-    #   },
-    # ...
-
-    command = f"jf rt s {pef_path}"
-
-    output = subprocess.run(command, shell=True, capture_output=True, text=True)
-    assert output.returncode == 0, f"Got bad returncode for '{command}' with error {output.stderr}"
-    output = output.stdout
-
-    out_json = json.loads(output)
-    # out_json is a list of file metadata for each file in the coe_pef folder
-    for file_metadata in out_json:
-        filepath = file_metadata["path"]
+    files = get_backend(pef_path).list(pef_path, recursive=True)
+    metadata = _af_pef_metadata(files)
+    if metadata is None:
+        raise ValueError(f"No .pef file found in {pef_path}: {[f.path for f in files]}")
+    return metadata
+
+def _af_pef_metadata(files: List[ObjectInfo]) -> Dict:
+    """Return the PEF metadata for the first .pef in a list of artifactory files, or None if there is no .pef"""
+    # files has the metadata of each file in the coe_pef folder
+    for file_metadata in files:
         # want the metadata for the .pef file specifically
-        if filepath.endswith(".pef"):
+        if file_metadata.path.endswith(".pef"):
             return {
-                "md5": file_metadata["md5"], 
-                "upload_date": file_metadata["created"], 
-                "path": filepath
+                "md5": file_metadata.md5, 
+                "upload_date": file_metadata.created, 
+                "path": file_metadata.path,
+                "validator": {"modified": file_metadata.modified, "sha256": file_metadata.sha256},
             }
-    
-    raise ValueError(f"No .pef file found in output {out_json}")
+    return None
+
+def cache_af_pef_metadata(folder_files: Dict[str, List[Dict]]):
+    """
+        Cache the PEF metadata for studio folders from a bulk artifactory search (see artifactory.bulk_search)
+        Folders without a .pef are skipped, a later lookup for them fails the same way as a per-folder search
+    """
+    with _CACHE_LOCK:
+        for folder, files in folder_files.items():
+            metadata = _af_pef_metadata(files)
+            if metadata is not None:
+                update_cache(folder, metadata)
 
 def _get_gcs_pef_metadata(pef_path: str):
     """
         Retrieves PEF metadata (md5sum, upload date, path) from GCS.
-        Parses data from the output of gsutil stat <filepath>. See comment for an example output
         Input: actual path to the PEF
     """
-    # <path>:
-    #     Creation time:          Thu, 20 Feb 2025 18:27:17 GMT
-    #     Update time:            Thu, 20 Feb 2025 18:27:17 GMT
-    #     Storage class:          STANDARD
-    #     Content-Length:         3354423528
-    #     Content-Type:           application/octet-stream
-    #     Metadata:               
-    #         goog-reserved-file-mtime:1738202406
-    #     Hash (crc32c):          YeC9gg==
-    #     Hash (md5):             skySRE+gMILYnhNWuLR0Eg==
-    #     ETag:                   CKuVxbDw0osDEAE=
-    #     Generation:             1740076036999851
-    #     Metageneration:         1
-    command = f"gsutil stat {pef_path}"
-    output = subprocess.run(command.split(), capture_output=True, text=True)
-    assert output.returncode == 0, f"Got bad returncode for '{command}' with error {output.stderr}"
-    output = output.stdout
-
-    data = {}
-    lines = output.split("\n")
-    data["path"] = lines[0].strip(":\n")
-    for line in lines[1:]:
-        line = line.strip()
-        key = line.split(":")[0]
-        val = ":".join(line.split(":")[1:]).strip()
-        data[key] = val
-    data["md5_decoded"] = base64.b64decode(data["Hash (md5)"]).hex()
+    return _gcs_pef_metadata(get_backend(pef_path).stat(pef_path))
+
+def _gcs_pef_metadata(pef: ObjectInfo) -> Dict:
+    """Build the cached PEF metadata from the GCS metadata of a single object"""
     return {
-        "md5": data["md5_decoded"], 
-        "upload_date": data["Creation time"], 
-        "path": data["path"]
+        "md5": pef.md5, 
+        "upload_date": pef.created, 
+        "path": pef.path,
+        "validator": {"generation": pef.generation, "metageneration": pef.metageneration, "etag": pef.etag},
     }
 
+def gcs_listing_prefix(path: str) -> str:
+    """
+        Return the GCS prefix to list recursively for a PEF path (or a folder containing a PEF)
+        PEFs are grouped by the '.../pefs/' folder they live under, otherwise by their parent folder
+    """
+    marker = "/pefs/"
+    if marker in path:
+        return path[:path.index(marker) + len(marker)]
+    if path.endswith("/"):
+        return path
+    return path.rsplit("/", 1)[0] + "/"
+
+def _list_gcs_pefs(prefix: str) -> Dict[str, Dict]:
+    """
+        Return the metadata of every .pef object under prefix, using a single recursive listing
+        Returns an empty dict if the listing fails, so that callers fall back to per-PEF lookups
+    """
+    print(f"Listing PEFs under {prefix}")
+    try:
+        objects = get_backend(prefix).list(prefix, recursive=True, suffix=".pef")
+    except StorageError as e:
+        print(f"Could not list {prefix}, falling back to per-PEF lookups: {e}")
+        return {}
+
+    # Composite objects have no md5 and can't be compared
+    return {pef.path: _gcs_pef_metadata(pef) for pef in objects if pef.md5 is not None}
+
+def prefetch_gcs_pef_metadata(pef_paths: List[str]):
+    """
+        Fill the cache for many GCS PEFs at once, with one recursive listing per distinct prefix
+        pef_paths may be cloud PEF paths or studio folders containing a PEF, non-GCS paths are ignored
+        Every .pef found under a listed prefix is cached (or revalidated), not just the ones in pef_paths
+    """
+    with _CACHE_LOCK:
+        uncached = sorted({p for p in pef_paths if p.startswith("gs://") and check_cache(p) is None})
+
+    paths_by_prefix = {}
+    for path in uncached:
+        paths_by_prefix.setdefault(gcs_listing_prefix(path), []).append(path)
+    # Prefixes with only a few uncached PEFs are cheaper to stat individually
+    prefixes = sorted(p for p, paths in paths_by_prefix.items() if len(paths) >= PREFIX_LISTING_MIN_PATHS)
+
+    for prefix, pefs in zip(prefixes, get_executor().map(_list_gcs_pefs, prefixes)):
+        studio_folders = {p for p in paths_by_prefix[prefix] if p.endswith("/")}
+        with _CACHE_LOCK:
+            # Sorted so a studio folder gets the first .pef in it, the same one gsutil ls would return
+            for path in sorted(pefs):
+                update_cache(path, pefs[path])
+                folder = path.rsplit("/", 1)[0] + "/"
+                if folder in studio_folders:
+                    update_cache(folder, pefs[path])
+                    studio_folders.remove(folder)
+        print(f"Cached {len(pefs)} PEFs under {prefix}")
+
 def date_difference(date1, date2):
     """Compute the difference in days between date1 and date2"""
+    # Only needed when PEFs differ, so not imported at startup
+    import dateutil.parser
+
     # Parse the dates using dateutil (handles both formats well)
     dt1 = dateutil.parser.parse(date1)
     dt2 = dateutil.parser.parse(date2)
@@ -166,21 +280,37 @@ def date_difference(date1, date2):
     delta = dt1_utc - dt2_utc
     return delta.days 
 
+def fetch_pef_metadata(pef_pairs: List[Tuple[str, str]]) -> List[Tuple[Dict, Dict]]:
+    """
+        Fetch the metadata for a list of (cloud_pef, studio_pef) paths concurrently
+        Returns a list of (cloud_metadata, studio_metadata) in the same order as pef_pairs
+    """
+    executor = get_executor()
+    futures = [
+        (executor.submit(get_cloud_pef_metadata, cloud_pef), executor.submit(get_studio_pef_metadata, studio_pef))
+        for cloud_pef, studio_pef in pef_pairs
+    ]
+    return [(cloud_future.result(), studio_future.result()) for cloud_future, studio_future in futures]
+
+def get_pef_pairs(cloud_pefs: Dict[str, Dict], studio_pef: str, common_bs: List[int]) -> List[Tuple[str, str]]:
+    """Return the (cloud_pef, studio_pef) paths to compare for each batch size in common_bs"""
+    return [(cloud_pefs[str(bs)]['pef_path'], get_studio_pef_folder(studio_pef, bs)) for bs in common_bs]
+
+def get_studio_pef_folder(studio_pef: str, bs: int) -> str:
+    """Return the folder containing the PEF for batch size bs. The Studio pef_path contains all the bs pefs"""
+    return os.path.join(replace_af_prefix(studio_pef), f"bs{bs}/coe_pef/")
+
 def compare_pefs(cloud_pefs: Dict[str, Dict], studio_pef: str, common_bs: List[int]):
     common_bs_with_matching_pefs, common_bs_different_pefs = [], []
-    studio_pef_folder = studio_pef.replace("{{ARTIFACTS_REPO}}", "sw-generic-daas-artifacts-dev")
-    for bs in common_bs:
-        cloud_pef = cloud_pefs[str(bs)]['pef_path']
+    pef_pairs = get_pef_pairs(cloud_pefs, studio_pef, common_bs)
 
-        # Studio path contains all the bs pefs, just look at the bs in question
-        studio_pef = os.path.join(studio_pef_folder, f"bs{bs}/coe_pef/")
-        print(f"Comparing...\n{cloud_pef}\n{studio_pef}")
-        
-        studio_metadata = get_studio_pef_metadata(studio_pef)
-        cloud_metadata = get_cloud_pef_metadata(cloud_pef)
+    # Look up all batch sizes at once, then compare them in batch size order
+    pef_metadata = fetch_pef_metadata(pef_pairs)
+    for bs, (cloud_pef, studio_pef), (cloud_metadata, studio_metadata) in zip(common_bs, pef_pairs, pef_metadata):
+        log(f"Comparing...\n{cloud_pef}\n{studio_pef}")
 
         if studio_metadata["md5"] != cloud_metadata["md5"]:
-            print(f"NOT A MATCH")
+            log(f"NOT A MATCH")
             bs_json = {
                 "batch_size": bs, 
                 "cloud_pef": cloud_metadata, 
@@ -189,7 +319,7 @@ def compare_pefs(cloud_pefs: Dict[str, Dict], studio_pef: str, common_bs: List[i
             }
             common_bs_different_pefs.append(bs_json)
         else:
-            print("MATCH")
+            log("MATCH")
             common_bs_with_matching_pefs.append(bs)
 
     return common_bs_with_matching_pefs, common_bs_different_pefs, {x["batch_size"]: x["upload_date_difference_in_days"] for x in common_bs_different_pefs}
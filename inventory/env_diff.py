@@ -0,0 +1,250 @@
+"""
+    Compare the cloud inventories of any number of environments (and optionally the studio inventory) in one run
+    Every inventory is keyed by InventoryKey and joined in a single pass, the result is one wide presence matrix with,
+    for each key, which inventories have it, their batch sizes, PEF md5sums and checkpoint manifest digests,
+    and which of those differ between the inventories that have the key
+
+    An inventory is an sn_iac environment from sn_iac_clusters.yaml, optionally restricted to some of its clusters,
+    and can be given a column name:
+        python env_diff.py production jp=production:fast-snova-ai-jp-prod-2 us=production:fast-snova-ai-prod-0,fast-snova-ai-prod-1
+    Other environments (e.g. staging) can be compared once their clusters are listed in sn_iac_clusters.yaml
+    The studio inventory is added as 'studio' unless --no-studio is given
+    --offline skips the PEF and checkpoint lookups and only compares presence and batch sizes
+
+    Usage: python env_diff.py INVENTORY [INVENTORY ...] [--no-studio] [--offline] [--output FILE] [--quiet] [--metrics FILE] [--trace FILE]
+"""
+import argparse
+import csv
+import json
+from concurrent.futures import Future
+from typing import Dict, List, NamedTuple, Tuple
+
+import metrics
+from cloud_inventory import get_cloud_configs, load_deployments
+from compare_inventories import get_cloud_inventory, read_studio_inventory, prefetch_artifactory
+from compare_models import _get_hashes
+from compare_pefs import get_cloud_pef_metadata, get_studio_pef_metadata, get_studio_pef_folder, prefetch_gcs_pef_metadata, get_executor
+from metrics import METRICS, log
+from schemas import InventoryKey
+from tfvars import get_cluster_deployments
+from utils import CONFIG, get_cluster_files, get_tfvars_dir, get_deployments_dir, replace_af_prefix, jsonl_path, write_jsonl
+
+ENVIRONMENT_DIFF_OUTPUT = "output/environment_diff.csv"
+STUDIO = "studio"
+
+
+class ArtifactView(NamedTuple):
+    """The artifacts of one inventory row that are compared across inventories"""
+    batch_sizes: List[int]
+    # batch size -> cloud PEF path or studio PEF folder
+    pefs: Dict[int, str]
+    # model name -> checkpoint folder
+    checkpoints: Dict[str, str]
+    is_studio: bool
+
+
+def cloud_view(record: Dict) -> ArtifactView:
+    """View of a typed cloud inventory record, see CloudConfig.to_record"""
+    return ArtifactView(
+        batch_sizes=record["batch_sizes"],
+        pefs={int(bs): pef["pef_path"] for bs, pef in record["cloud_pefs_json"].items()},
+        checkpoints=record["cloud_models"],
+        is_studio=False,
+    )
+
+
+def studio_view(row: Dict, cloud_names: Dict[str, str]) -> ArtifactView:
+    """View of a studio inventory row. Studio model names are translated to the cloud names in cloud_names, so checkpoints line up"""
+    batch_sizes = json.loads(row["batch_sizes"])
+    model_name = row["model_checkpoint_name"]
+    return ArtifactView(
+        batch_sizes=batch_sizes,
+        pefs={bs: get_studio_pef_folder(row["pef_path"], bs) for bs in batch_sizes},
+        checkpoints={cloud_names.get(model_name, model_name): replace_af_prefix(row["model_path"])},
+        is_studio=True,
+    )
+
+
+def parse_inventory_spec(spec: str) -> Tuple[str, str, List[str]]:
+    """Parse '[name=]environment[:cluster,...]' into (name, environment, clusters), clusters is empty for the whole environment"""
+    name, _, target = spec.rpartition("=")
+    environment, _, clusters = target.partition(":")
+    return name or target, environment, [c for c in clusters.split(",") if c]
+
+
+def get_environment_deployments(environment: str, clusters: List[str]) -> set:
+    """Return the names of the deployments running on the given clusters of an environment, or on all of its clusters"""
+    if clusters:
+        cluster_files = {cluster: get_tfvars_dir(environment) / f"{cluster}.tfvars" for cluster in clusters}
+    else:
+        cluster_files = get_cluster_files(environment)
+    active_deployments = set()
+    for cluster_deployments in get_cluster_deployments(cluster_files).values():
+        active_deployments.update(cluster_deployments)
+    return active_deployments
+
+
+def load_cloud_inventories(specs: List[str]) -> Dict[str, Dict[InventoryKey, Dict]]:
+    """
+        Return inventory name -> typed cloud inventory for every spec (see parse_inventory_spec)
+        Deployment files are parsed once per deployments folder, for all the inventories that use it
+    """
+    targets = {}
+    for spec in specs:
+        name, environment, clusters = parse_inventory_spec(spec)
+        if name in targets or name == STUDIO:
+            raise ValueError(f"Duplicate inventory name {name}, name it with <name>={spec}")
+        targets[name] = (get_deployments_dir(environment), get_environment_deployments(environment, clusters))
+
+    parsed = {}
+    for deployments_dir in {d for d, _ in targets.values()}:
+        active = set().union(*(a for d, a in targets.values() if d == deployments_dir))
+        parsed[deployments_dir] = load_deployments(active, deployments_dir=deployments_dir)
+
+    inventories = {}
+    for name, (deployments_dir, active) in targets.items():
+        deployments = {stem: d for stem, d in parsed[deployments_dir].items() if d.metadata.name in active}
+        inventories[name] = get_cloud_inventory(get_cloud_configs(deployments))
+    return inventories
+
+
+def hash_join(inventories: Dict[str, Dict[InventoryKey, object]]) -> Dict[InventoryKey, Dict[str, object]]:
+    """Join any number of keyed inventories in one pass: key -> {inventory name: value} for the inventories that have the key"""
+    joined = {}
+    for name, inventory in inventories.items():
+        for key, value in inventory.items():
+            joined.setdefault(key, {})[name] = value
+    return joined
+
+
+def _result_or_none(future: Future, what: str):
+    """Lookups that fail are reported and left out of the comparison instead of failing the whole diff"""
+    try:
+        return future.result()
+    except Exception as e:
+        print(f"Could not look up {what}: {e}")
+        return None
+
+
+def start_lookups(joined: Dict[InventoryKey, Dict[str, ArtifactView]]) -> Tuple[Dict[str, Future], Dict[str, Future]]:
+    """Start the metadata lookups of every PEF and checkpoint in joined, return path -> Future of the PEF metadata / checkpoint manifest"""
+    pef_paths = {}
+    checkpoints = set()
+    for views in joined.values():
+        for view in views.values():
+            pef_paths.update({path: view.is_studio for path in view.pefs.values()})
+            checkpoints.update(view.checkpoints.values())
+    prefetch_gcs_pef_metadata(list(pef_paths))
+
+    executor = get_executor()
+    pef_futures = {
+        path: executor.submit(get_studio_pef_metadata if is_studio else get_cloud_pef_metadata, path)
+        for path, is_studio in pef_paths.items()
+    }
+    return pef_futures, {path: _get_hashes(path) for path in checkpoints}
+
+
+def _differing(values: Dict[str, Dict]) -> List:
+    """Return the sorted keys whose value isn't the same in every inventory that has the key. None values are unknown and skipped"""
+    by_key = {}
+    for inventory_values in values.values():
+        for k, v in inventory_values.items():
+            if v is not None:
+                by_key.setdefault(k, set()).add(v)
+    return sorted(k for k, distinct in by_key.items() if len(distinct) > 1)
+
+
+def diff_rows(joined: Dict[InventoryKey, Dict[str, ArtifactView]], names: List[str],
+              pef_futures: Dict[str, Future] = None, checkpoint_futures: Dict[str, Future] = None) -> List[Dict]:
+    """Build one presence matrix row per key, in key order. Without lookups, only presence and batch sizes are compared"""
+    rows = []
+    for key in sorted(joined, key=str):
+        views = joined[key]
+        row = {"id": str(key), "group_id": key.group_id, "present_in": [n for n in names if n in views]}
+        pef_md5s, checkpoint_digests = {}, {}
+        for name in names:
+            view = views.get(name)
+            row[f"in_{name}"] = view is not None
+            row[f"batch_sizes_{name}"] = view.batch_sizes if view is not None else None
+            if view is None or pef_futures is None:
+                continue
+            pef_md5s[name] = {}
+            for bs, path in view.pefs.items():
+                metadata = _result_or_none(pef_futures[path], path)
+                pef_md5s[name][bs] = metadata["md5"] if metadata is not None else None
+            checkpoint_digests[name] = {}
+            for model_name, path in view.checkpoints.items():
+                manifest = _result_or_none(checkpoint_futures[path], path)
+                checkpoint_digests[name][model_name] = manifest["digest"] if manifest is not None else None
+            row[f"pef_md5s_{name}"] = pef_md5s[name]
+            row[f"checkpoints_{name}"] = checkpoint_digests[name]
+
+        row["batch_sizes_differ"] = len({tuple(views[n].batch_sizes) for n in row["present_in"]}) > 1
+        if pef_futures is not None:
+            row["different_pef_bs"] = _differing(pef_md5s)
+            row["different_checkpoints"] = _differing(checkpoint_digests)
+        rows.append(row)
+    return rows
+
+
+def diff_fields(names: List[str], lookups: bool = True) -> List[str]:
+    """Columns of the presence matrix for the given inventory names"""
+    fields = ["id", "group_id", "present_in"]
+    fields += [f"in_{name}" for name in names]
+    fields += [f"batch_sizes_{name}" for name in names] + ["batch_sizes_differ"]
+    if lookups:
+        fields += [f"pef_md5s_{name}" for name in names] + ["different_pef_bs"]
+        fields += [f"checkpoints_{name}" for name in names] + ["different_checkpoints"]
+    return fields
+
+
+def diff_environments(specs: List[str], studio: bool = True, lookups: bool = True) -> Tuple[List[Dict], List[str]]:
+    """Load and diff the inventories, return the presence matrix rows and its columns"""
+    with METRICS.span("load"):
+        inventories = {name: {k: cloud_view(r) for k, r in inventory.items()} for name, inventory in load_cloud_inventories(specs).items()}
+        if studio:
+            studio_inventory, _ = read_studio_inventory()
+            cloud_names = {studio_name: cloud_name for cloud_name, studio_name in CONFIG.get("cloud_studio_model_mappings").items()}
+            inventories[STUDIO] = {k: studio_view(r, cloud_names) for k, r in studio_inventory.items()}
+    names = list(inventories)
+
+    with METRICS.span("compare"):
+        joined = hash_join(inventories)
+        pef_futures, checkpoint_futures = None, None
+        if lookups:
+            if studio and studio_inventory:
+                prefetch_artifactory(studio_inventory.values())
+            pef_futures, checkpoint_futures = start_lookups(joined)
+        rows = diff_rows(joined, names, pef_futures, checkpoint_futures)
+    for row in rows:
+        log(f"{row['id']}: in {', '.join(row['present_in'])}")
+    return rows, diff_fields(names, lookups)
+
+
+def write_diff(rows: List[Dict], fields: List[str], filename: str = ENVIRONMENT_DIFF_OUTPUT):
+    """Write the presence matrix to the csv filename, and with typed values to the JSON-Lines file next to it"""
+    with open(filename, "w") as f:
+        writer = csv.DictWriter(f, fieldnames=fields, quoting=csv.QUOTE_MINIMAL)
+        writer.writeheader()
+        writer.writerows(rows)
+    write_jsonl(jsonl_path(filename), rows, fields)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inventories", nargs="+", help="[name=]environment[:cluster,...]")
+    parser.add_argument("--no-studio", action="store_true", help="Only compare the cloud inventories with each other")
+    parser.add_argument("--offline", action="store_true", help="Don't look up PEF md5sums and checkpoint manifests")
+    parser.add_argument("--output", default=ENVIRONMENT_DIFF_OUTPUT)
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure(args)
+
+    try:
+        rows, fields = diff_environments(args.inventories, studio=not args.no_studio, lookups=not args.offline)
+    except ValueError as e:
+        parser.error(str(e))
+    with METRICS.span("write"):
+        write_diff(rows, fields, args.output)
+    print(f"Wrote {len(rows)} keys to {args.output}")
+    metrics.finish(args)
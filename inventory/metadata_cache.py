@@ -0,0 +1,150 @@
+import sqlite3
+import json
+import threading
+import time
+import yaml
+from collections.abc import MutableMapping
+from pathlib import Path
+from typing import Dict, Iterator, Union, NamedTuple, Optional
+
+
+class CacheEntry(NamedTuple):
+    """A cached value with the storage validator it was fetched with (e.g. GCS generation) and when it was last validated"""
+    metadata: Dict
+    validator: Optional[Dict]
+    validated_at: Optional[float]
+
+
+class MetadataCache(MutableMapping):
+    """
+        Persistent path -> metadata cache backed by SQLite
+        Behaves like a dict, but every write is committed immediately so nothing is lost if a run is killed
+        Each thread gets its own connection and the database uses WAL mode,
+        so parallel workers (threads or processes) can read and write at the same time
+        Entries may also record a validator and the time they were last validated, see get_entry() and put()
+    """
+
+    def __init__(self, db_file: Union[str, Path], migrate_from: Union[str, Path, None] = None):
+        self.db_file = Path(db_file)
+        self.migrate_from = Path(migrate_from) if migrate_from is not None else None
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """Return this thread's connection, creating the database on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._init_lock:
+                if not self._initialized:
+                    self._create_tables(conn)
+                    self._initialized = True
+        return conn
+
+    def _create_tables(self, conn: sqlite3.Connection):
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS metadata (path TEXT PRIMARY KEY, value TEXT NOT NULL, validator TEXT, validated_at REAL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS migrations (source TEXT PRIMARY KEY)")
+            # Databases created before validators were recorded
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(metadata)")}
+            if "validator" not in columns:
+                conn.execute("ALTER TABLE metadata ADD COLUMN validator TEXT")
+                conn.execute("ALTER TABLE metadata ADD COLUMN validated_at REAL")
+        if self.migrate_from is not None:
+            self._migrate_yaml(conn, self.migrate_from)
+
+    def _migrate_yaml(self, conn: sqlite3.Connection, yaml_file: Path):
+        """One-time import of a YAML cache file (the previous cache format). Entries already in the database are kept"""
+        source = yaml_file.name
+        if not yaml_file.exists():
+            return
+        if conn.execute("SELECT 1 FROM migrations WHERE source = ?", (source,)).fetchone():
+            return
+
+        print(f"Migrating cache from {yaml_file}...", end=" ")
+        with open(yaml_file) as f:
+            entries = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader)) or {}
+        # Another process may be migrating the same file: BEGIN IMMEDIATE takes the write lock,
+        # so checking the marker row and importing the entries happen as one step
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM migrations WHERE source = ?", (source,)).fetchone():
+                conn.rollback()
+                print("already migrated by another process")
+                return
+            # Migrated entries have no validator or validation time, so any age policy revalidates them
+            conn.executemany(
+                "INSERT OR IGNORE INTO metadata (path, value) VALUES (?, ?)",
+                ((path, json.dumps(value)) for path, value in entries.items())
+            )
+            conn.execute("INSERT INTO migrations (source) VALUES (?)", (source,))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        print(f"{len(entries)} entries")
+
+    def __getitem__(self, path: str) -> Dict:
+        row = self._conn.execute("SELECT value FROM metadata WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            raise KeyError(path)
+        return json.loads(row[0])
+
+    def __setitem__(self, path: str, metadata: Dict):
+        self.put(path, metadata)
+
+    def get_entry(self, path: str) -> Optional[CacheEntry]:
+        """Return the cached metadata for path along with its validator and last validation time, or None"""
+        row = self._conn.execute("SELECT value, validator, validated_at FROM metadata WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+        value, validator, validated_at = row
+        return CacheEntry(json.loads(value), json.loads(validator) if validator else None, validated_at)
+
+    def put(self, path: str, metadata: Dict, validator: Optional[Dict] = None):
+        """Store metadata for path, recording the validator it was fetched with and the current time"""
+        with self._conn as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO metadata (path, value, validator, validated_at) VALUES (?, ?, ?, ?)",
+                (path, json.dumps(metadata), json.dumps(validator) if validator else None, time.time())
+            )
+
+    def touch(self, path: str):
+        """Mark the entry for path as validated now, without changing it"""
+        with self._conn as conn:
+            conn.execute("UPDATE metadata SET validated_at = ? WHERE path = ?", (time.time(), path))
+
+    def __delitem__(self, path: str):
+        with self._conn as conn:
+            cursor = conn.execute("DELETE FROM metadata WHERE path = ?", (path,))
+        if cursor.rowcount == 0:
+            raise KeyError(path)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter([row[0] for row in self._conn.execute("SELECT path FROM metadata ORDER BY path")])
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+
+    def __contains__(self, path) -> bool:
+        return self._conn.execute("SELECT 1 FROM metadata WHERE path = ?", (path,)).fetchone() is not None
+
+    def setdefault(self, path: str, metadata: Dict) -> Dict:
+        """Store metadata for path unless it already has an entry, and return the stored entry"""
+        with self._conn as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO metadata (path, value, validated_at) VALUES (?, ?, ?)",
+                (path, json.dumps(metadata), time.time())
+            )
+        return self[path]
+
+    def clear(self):
+        with self._conn as conn:
+            conn.execute("DELETE FROM metadata")
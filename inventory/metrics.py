@@ -0,0 +1,160 @@
+import argparse
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List
+
+# INVENTORY_QUIET=1 (or --quiet) turns off the per-item prints, e.g. one line per cache lookup or PEF comparison
+QUIET = os.environ.get("INVENTORY_QUIET", "0") == "1"
+
+
+def log(message: str):
+    """Print a per-item progress message, unless in quiet mode. Summaries and warnings should use print()"""
+    if not QUIET:
+        print(message)
+
+
+class Metrics():
+    """
+        Thread-safe collector for timing spans, remote call latencies and cache hits / misses
+        summary() aggregates them for a JSON metrics file, trace_events() lists every span in the Chrome trace event format
+        (open the trace file in chrome://tracing or https://ui.perfetto.dev)
+        Worker processes record into their own copy of METRICS, which the parent has to export() and merge() back
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Drop everything recorded so far and restart the wall time, e.g. at the start of each watch.py refresh"""
+        self._start = time.perf_counter()
+        # name -> [count, total seconds, max seconds]
+        self._stages: Dict[str, List] = {}
+        self._calls: Dict[str, List] = {}
+        # cache name -> Counter of events (hit, miss, ...)
+        self._caches: Dict[str, Counter] = {}
+        self._events: List[Dict] = []
+
+    @staticmethod
+    def _add(timings: Dict[str, List], name: str, seconds: float):
+        entry = timings.setdefault(name, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+
+    @contextmanager
+    def span(self, name: str, category: str = "stage", **args):
+        """Time the enclosed block as a span named name. Spans can be nested and opened from any thread"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                if category == "stage":
+                    self._add(self._stages, name, end - start)
+                self._events.append({
+                    "name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                    "ts": (start - self._start) * 1e6, "dur": (end - start) * 1e6, "args": args,
+                })
+
+    @contextmanager
+    def call(self, backend: str, operation: str, target: str = None):
+        """Time a remote call (subprocess or HTTP request) made through backend"""
+        start = time.perf_counter()
+        with self.span(f"{backend} {operation}", category="call", target=target):
+            yield
+        with self._lock:
+            self._add(self._calls, backend, time.perf_counter() - start)
+
+    def cache(self, name: str, event: str):
+        """Record a cache lookup: event is 'hit', 'miss', or a kind of hit such as 'revalidated' or 'in_flight'"""
+        with self._lock:
+            self._caches.setdefault(name, Counter())[event] += 1
+
+    def export(self) -> Dict:
+        """Return everything recorded so far as plain data, to be sent from a worker process to the parent's merge()"""
+        with self._lock:
+            return {
+                "start": self._start,
+                "stages": {name: list(entry) for name, entry in self._stages.items()},
+                "calls": {name: list(entry) for name, entry in self._calls.items()},
+                "caches": {name: Counter(events) for name, events in self._caches.items()},
+                "events": list(self._events),
+            }
+
+    def merge(self, exported: Dict):
+        """Add the metrics exported by another process, its spans are moved to this process's timeline"""
+        # perf_counter is system-wide, only the start times differ
+        offset = (exported["start"] - self._start) * 1e6
+        with self._lock:
+            for timings, other in ((self._stages, exported["stages"]), (self._calls, exported["calls"])):
+                for name, (count, total, longest) in other.items():
+                    entry = timings.setdefault(name, [0, 0.0, 0.0])
+                    entry[0] += count
+                    entry[1] += total
+                    entry[2] = max(entry[2], longest)
+            for name, events in exported["caches"].items():
+                self._caches.setdefault(name, Counter()).update(events)
+            self._events.extend(dict(event, ts=event["ts"] + offset) for event in exported["events"])
+
+    def summary(self) -> Dict:
+        with self._lock:
+            caches = {}
+            for name, events in self._caches.items():
+                total = sum(events.values())
+                caches[name] = dict(events, hit_ratio=(total - events["miss"]) / total if total else None)
+            return {
+                "wall_time_s": time.perf_counter() - self._start,
+                "stages": {name: {"count": c, "total_s": t, "max_s": m} for name, (c, t, m) in self._stages.items()},
+                "calls": {name: {"count": c, "total_s": t, "mean_s": t / c, "max_s": m} for name, (c, t, m) in self._calls.items()},
+                "caches": caches,
+            }
+
+    def trace_events(self) -> List[Dict]:
+        with self._lock:
+            return list(self._events)
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"Finished in {summary['wall_time_s']:.1f}s")
+        for name, stage in summary["stages"].items():
+            print(f"  {name:<30}{stage['total_s']:9.2f}s" + (f"  ({stage['count']} times)" if stage["count"] > 1 else ""))
+        for name, calls in summary["calls"].items():
+            print(f"  {name + ' calls':<30}{calls['count']:6d}   mean {calls['mean_s'] * 1000:.0f} ms, max {calls['max_s'] * 1000:.0f} ms")
+        for name, cache in summary["caches"].items():
+            events = ", ".join(f"{count} {event}" for event, count in cache.items() if event != "hit_ratio")
+            print(f"  {name + ' cache':<30}{cache['hit_ratio']:6.0%} hits   ({events})")
+
+
+METRICS = Metrics()
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Add the --quiet, --metrics and --trace options to an entry point's parser"""
+    parser.add_argument("--quiet", action="store_true", default=QUIET, help="Don't print a line per deployment / cache lookup / comparison")
+    parser.add_argument("--metrics", type=Path, default=os.environ.get("INVENTORY_METRICS"), help="Write stage timings, remote calls and cache hit ratios to this JSON file")
+    parser.add_argument("--trace", type=Path, default=os.environ.get("INVENTORY_TRACE"), help="Write every span to this Chrome trace event file")
+
+
+def configure(args: argparse.Namespace):
+    """Apply the options added by add_arguments"""
+    global QUIET
+    QUIET = args.quiet
+    # So worker processes started by a ProcessPoolExecutor are quiet too
+    os.environ["INVENTORY_QUIET"] = "1" if QUIET else "0"
+
+
+def finish(args: argparse.Namespace):
+    """Print the summary and write the files requested with add_arguments"""
+    METRICS.print_summary()
+    if args.metrics:
+        with open(args.metrics, "w") as f:
+            json.dump(METRICS.summary(), f, indent=2)
+    if args.trace:
+        with open(args.trace, "w") as f:
+            json.dump({"traceEvents": METRICS.trace_events(), "displayTimeUnit": "ms"}, f)
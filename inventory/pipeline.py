@@ -0,0 +1,42 @@
+"""
+    Build the cloud inventory and compare it with the studio inventory in a single process
+    Same outputs as running cloud_inventory.py then compare_inventories.py, but the CloudConfigs are passed
+    straight to the InventoryComparer instead of being written to cloud_inventory.csv and parsed back.
+    cloud_inventory.csv and cloud_inventory_gtm.csv are still written, as outputs
+
+    Usage: python pipeline.py [--incremental] [--quiet] [--metrics FILE] [--trace FILE]
+"""
+import argparse
+
+import cloud_inventory
+import metrics
+from compare_inventories import InventoryComparer
+from metrics import METRICS
+
+
+def run(incremental: bool = False) -> InventoryComparer:
+    """Build the cloud configs, write the cloud inventory and the comparison outputs, and return the comparer"""
+    with METRICS.span("load"):
+        active_deployments = cloud_inventory.get_active_deployments()
+    with METRICS.span("parse"):
+        deployments = cloud_inventory.load_deployments(active_deployments, incremental=incremental)
+    with METRICS.span("merge"):
+        configs = cloud_inventory.get_cloud_configs(deployments)
+    with METRICS.span("write"):
+        cloud_inventory.write_inventory(configs)
+        cloud_inventory.write_inventory_gtm(configs)
+
+    comparer = InventoryComparer(configs)
+    comparer.write()
+    return comparer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--incremental", action="store_true", help=f"Only re-parse deployments that changed since the last incremental build (state is kept in {cloud_inventory.MANIFEST_FILE.name})")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure(args)
+
+    run(incremental=args.incremental)
+    metrics.finish(args)
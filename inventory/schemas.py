@@ -2,7 +2,9 @@
 from pydantic import BaseModel, Field, PrivateAttr
 from typing import List, Dict, Optional, Union, Tuple
 from utils import get_expert_seq_len, get_app_name, get_parameter_count, normalize_expert_name, get_pef_jira, convert_seq_len
-from dataclasses import dataclass, fields
+from dataclasses import dataclass, field
+import ast
+import copy
 import json
 
 ######## Pydantic classes for cloud deployment yamls ############
@@ -82,18 +84,44 @@ class InferenceDeployment(BaseModel):
 ######## Custom classes ############
 
 
-@dataclass(frozen=True)
+class InvalidDictForInventoryKey(Exception):
+    pass
+
+
+class InvalidObjectForInventoryKey(Exception):
+    pass
+
+
+def _to_bool(val):
+    """Cast"""
+    if not isinstance(val, str):
+        return bool(val)
+    val_lower = val.lower()
+    if val_lower == "true":
+        return True
+    elif val_lower == "false":
+        return False
+    else:
+        raise ValueError(f"Invalid str for bool conversion: {val}")
+
+
+@dataclass(frozen=True, slots=True)
 class InventoryKey:
     """
         Class representing a key in the inventory
         Each row in the inventory represents a unique combination of the below parameters
 
         Instances of this class must be instantiated with from_input()
+        The string form, group_id and hash are computed once when the key is built, since keys are
+        hashed, compared and turned into strings all over the inventory comparison
     """
     app_name: str
     param_count: str
     sd: bool
     max_seq_length: int
+    _str: str = field(init=False, repr=False, compare=False)
+    _group_id: str = field(init=False, repr=False, compare=False)
+    _hash: int = field(init=False, repr=False, compare=False)
 
     fields_aliases = {
         "app_name": ["app_name", "model_app_name"],
@@ -101,6 +129,23 @@ class InventoryKey:
         "sd": ["sd", "spec_decoding", "speculative_decoding"],
         "max_seq_length": ["max_seq_length", "max_seq_len"]
     }
+    # dict keys -> from_row function built by row_factory, so from_input resolves aliases once per header
+    _row_factories = {}
+    # field name -> type, for the fields that make up the key
+    key_fields = {
+        "app_name": str,
+        "param_count": str,
+        "sd": bool,
+        "max_seq_length": int,
+    }
+
+    def __post_init__(self):
+        s = "-".join((str(self.app_name), str(self.param_count), str(self.sd), str(self.max_seq_length)))
+        s = s.replace(" ", "_") # App name has spaces
+        s = s.replace(".", "d") # App name might have "."
+        object.__setattr__(self, "_str", s)
+        object.__setattr__(self, "_group_id", "-".join(s.split("-")[:-1]))
+        object.__setattr__(self, "_hash", hash((self.app_name, self.param_count, self.sd, self.max_seq_length)))
 
     @classmethod
     def lookup_field(cls, fieldname: str, obj):
@@ -117,72 +162,97 @@ class InventoryKey:
             raise AttributeError
 
     @classmethod
-    def from_input(cls, obj: Union[Dict, object]) -> "InventoryKey":
+    def resolve_aliases(cls, names) -> Dict[str, str]:
         """
-            Instantiates an InventoryKey based on a dict or an arbitrary object
-            For dict-based instantiation the dict must have a key for each field in field(InventoryKey)
-            For object-based instantiation the dict must have an attribute for each field in field(InventoryKey)
+            Return field name -> the alias used for it, given the keys of a dict (e.g. a CSV header) or the attributes of an object
+            Raises KeyError if a field has no alias in names
         """
-
-        def to_bool(val):
-            """Cast"""
-            if not isinstance(val, str):
-                return bool(val)
-            val_lower = val.lower()
-            if val_lower == "true":
-                return True
-            elif val_lower == "false":
-                return False
+        resolved = {}
+        for fieldname, aliases in cls.fields_aliases.items():
+            for alias in aliases:
+                if alias in names:
+                    resolved[fieldname] = alias
+                    break
             else:
-                raise ValueError(f"Invalid str for bool conversion: {val}")
-
-        class InvalidDictForInventoryKey(Exception):
-            pass
-
-        class InvalidObjectForInventoryKey(Exception):
-            pass
+                raise KeyError(fieldname)
+        return resolved
 
+    @classmethod
+    def _from_values(cls, values: Dict) -> "InventoryKey":
+        """Cast the field values to the right types and build the key"""
         init_kwargs = {}
-        field_names = {f.name for f in fields(cls)}
+        for fieldname, fieldtype in cls.key_fields.items():
+            val = values[fieldname]
+            if fieldtype == bool:
+                val = _to_bool(val)
+            else:
+                try:
+                    val = fieldtype(val)
+                except ValueError as e:
+                    print(f"Could not convert field {fieldname} with value {val} to type {fieldtype}")
+            init_kwargs[fieldname] = val
+        return cls(**init_kwargs)
+
+    @classmethod
+    def row_factory(cls, fieldnames: List[str]):
+        """
+            Return a function that builds an InventoryKey from a row of a CSV with the given header
+            Aliases are resolved once for the header instead of once per row
+        """
         try:
-            for field in fields(cls):
-                # Get the value of the field from obj, cast it to the right type, store it in init_kwargs
-                if field.type == bool:
-                    val = to_bool(InventoryKey.lookup_field(field.name, obj))
-                else:
-                    try:
-                        val = InventoryKey.lookup_field(field.name, obj)
-                        val = field.type(val)
-                    except ValueError as e:
-                        print(f"Could not convert field {field.name} with value {val} to type {field.type}")
-                init_kwargs[field.name] = val
+            aliases = cls.resolve_aliases(set(fieldnames))
         except KeyError:
             raise InvalidDictForInventoryKey(
-                f"Expected keys {field_names} in dict used for InventoryKey initialization, got {sorted(list(obj.keys()))}"
+                f"Expected keys {set(cls.key_fields)} in dict used for InventoryKey initialization, got {sorted(list(fieldnames))}"
             )
+        alias_items = tuple(aliases.items())
+
+        def from_row(row: Dict) -> "InventoryKey":
+            return cls._from_values({fieldname: row[alias] for fieldname, alias in alias_items})
+
+        return from_row
+
+    @classmethod
+    def from_input(cls, obj: Union[Dict, object]) -> "InventoryKey":
+        """
+            Instantiates an InventoryKey based on a dict or an arbitrary object
+            For dict-based instantiation the dict must have a key for each field in field(InventoryKey)
+            For object-based instantiation the dict must have an attribute for each field in field(InventoryKey)
+        """
+        if isinstance(obj, dict):
+            header = tuple(obj.keys())
+            if header not in cls._row_factories:
+                cls._row_factories[header] = cls.row_factory(header)
+            return cls._row_factories[header](obj)
+
+        try:
+            values = {fieldname: InventoryKey.lookup_field(fieldname, obj) for fieldname in cls.key_fields}
         except AttributeError:
             raise InvalidObjectForInventoryKey(
-                f"Expected attributes {field_names} in object used for InventoryKey initialization, got {sorted(list(dir(obj)))}"
+                f"Expected attributes {set(cls.key_fields)} in object used for InventoryKey initialization, got {sorted(list(dir(obj)))}"
             )
+        return cls._from_values(values)
 
-        return cls(**init_kwargs)
+    def __reduce__(self):
+        # Rebuild from the key fields when unpickling, the cached hash is only valid in the process that computed it
+        return (self.__class__, (self.app_name, self.param_count, self.sd, self.max_seq_length))
 
     def __str__(self):
         """Return this InventoryKey's fields joined together with '-' and spaces replaced with '_'"""
-        s = "-".join(tuple(str(getattr(self, x.name)) for x in fields(InventoryKey)))
-        s = s.replace(" ", "_") # App name has spaces
-        s = s.replace(".", "d") # App name might have "."
-        return s
+        return self._str
+
+    def __hash__(self):
+        return self._hash
 
     @property
     def group_id(self):
         """Return the group ID of this inventory key, which consists of all fields besides max_seq_length"""
-        return "-".join(str(self).split("-")[:-1])
+        return self._group_id
 
 
     def is_sibling(self, other_key: "InventoryKey"):
         """Check if this InventoryKey is a sibling of other_key. Sibling means Studio would load the artifacts for these keys together"""
-        return  self.group_id == other_key.group_id
+        return  self._group_id == other_key._group_id
 
 
 class PEF():
@@ -292,6 +362,15 @@ class CloudConfig():
     fieldnames = ["id", "group_id", "model_app_name", "experts", "deployments", "param_count", "max_seq_length", "max_seq_length_cloud", "spec_decoding", "batch_sizes", "cloud_pefs_json", "cloud_models", "draft_experts"]
     def to_row(self) -> Union[Dict, None]:
         """Return a dict representing this CloudConfig to be used for writing to a csv with DictWriter"""
+        record = self.to_record()
+        return CloudConfig.format_row(record) if record is not None else None
+
+
+    def to_record(self) -> Union[Dict, None]:
+        """
+            Return the inventory row of this CloudConfig with typed values (lists, dicts, ints and bools),
+            or None if the config is filtered out of the inventory
+        """
 
         # filter out models and apps with these substrings
         filter_substrings = [
@@ -310,9 +389,10 @@ class CloudConfig():
         if filtered_experts == []:
             return None
         
+        # Batch sizes are str keys, the same as after a round trip through json
         cloud_pefs_json = {}
         for pef in self.pefs.values():
-            cloud_pefs_json.update(pef.as_dict())
+            cloud_pefs_json.update({str(bs): pef_dict for bs, pef_dict in pef.as_dict().items()})
         return {
             "id": self.id,
             "group_id": self.group_id,
@@ -324,7 +404,7 @@ class CloudConfig():
             "max_seq_length_cloud": convert_seq_len(self.max_seq_length, str),
             "spec_decoding": self.sd, 
             "batch_sizes": self.batch_sizes, 
-            "cloud_pefs_json": json.dumps(cloud_pefs_json),
+            "cloud_pefs_json": cloud_pefs_json,
             "cloud_models": self.expert_to_checkpoint,
             "draft_experts": sorted(list(self.draft_experts))
         }
@@ -358,9 +438,45 @@ class CloudConfig():
         return rows
 
 
+    def copy(self) -> "CloudConfig":
+        """Return a copy of this CloudConfig that can be merged into without modifying this one"""
+        config = copy.copy(self)
+        config.pefs = dict(self.pefs)
+        config.expert_to_checkpoint = dict(self.expert_to_checkpoint)
+        return config
+
+
     def merge(self, other_config: "CloudConfig"):
         """Update this CloudConfig with the artifacts from the other_config"""
         self.pefs.update(other_config.pefs)
         self.expert_to_checkpoint.update(other_config.expert_to_checkpoint)
         self.draft_experts = self.draft_experts.union(other_config.draft_experts)
         self.deployments = self.deployments.union(other_config.deployments)
+
+
+    @staticmethod
+    def format_row(record: Dict) -> Dict:
+        """
+            Return a copy of a record from to_record (or of a row built from one) ready for DictWriter
+            cloud_pefs_json is JSON-encoded, every other field is left for DictWriter to write with str(), as in the old csv
+            (parse_row reads those back with ast.literal_eval)
+        """
+        if not isinstance(record.get("cloud_pefs_json"), dict):
+            return record
+        return dict(record, cloud_pefs_json=json.dumps(record["cloud_pefs_json"]))
+
+
+    @staticmethod
+    def parse_row(row: Dict[str, str]) -> Dict:
+        """Turn a row read back from the cloud inventory csv into the typed record to_record returned for it"""
+        return dict(
+            row,
+            experts=ast.literal_eval(row["experts"]),
+            deployments=ast.literal_eval(row["deployments"]),
+            max_seq_length=int(row["max_seq_length"]),
+            spec_decoding=_to_bool(row["spec_decoding"]),
+            batch_sizes=json.loads(row["batch_sizes"]),
+            cloud_pefs_json=json.loads(row["cloud_pefs_json"]),
+            cloud_models=ast.literal_eval(row["cloud_models"]),
+            draft_experts=ast.literal_eval(row["draft_experts"]),
+        )
@@ -0,0 +1,410 @@
+import base64
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional
+from urllib.parse import quote
+
+from artifactory import build_search_spec, search_criteria
+from metrics import METRICS
+from utils import parse_gsutil_listing
+
+# Which backend to use for remote lookups:
+#   auto  - the pooled API clients if their dependencies and credentials are available, otherwise the CLIs
+#   api   - the pooled API clients only
+#   cli   - a gsutil / jf subprocess per lookup
+#   local - a local directory laid out like the remote storage, see LocalBackend
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "auto")
+STORAGE_LOCAL_ROOT = os.environ.get("STORAGE_LOCAL_ROOT")
+# Max number of HTTP connections kept open per API client, should be at least the number of lookup threads
+STORAGE_POOL_SIZE = int(os.environ.get("STORAGE_POOL_SIZE", 32))
+
+GCS_API = "https://storage.googleapis.com/storage/v1"
+GCS_FIELDS = "name,md5Hash,size,timeCreated,updated,generation,metageneration,etag"
+
+
+class StorageError(RuntimeError):
+    """A remote lookup failed (missing object, bad credentials, CLI error...)"""
+
+
+class ObjectInfo(NamedTuple):
+    """Metadata of a single file in GCS or artifactory, whichever backend it was fetched with"""
+    path: str  # gs://bucket/object or repo/path/name
+    md5: Optional[str]  # hex, None for GCS composite objects
+    size: Optional[int]
+    created: Optional[str]  # in the format the storage CLI reports it, so cached upload dates don't depend on the backend
+    modified: Optional[str]
+    generation: Optional[str] = None  # GCS only
+    metageneration: Optional[str] = None  # GCS only
+    etag: Optional[str] = None  # GCS only
+    sha256: Optional[str] = None  # artifactory only
+
+
+class StorageBackend(ABC):
+    """Read-only access to file metadata in one storage system"""
+
+    @abstractmethod
+    def stat(self, path: str) -> ObjectInfo:
+        """Return the metadata of a single file"""
+
+    @abstractmethod
+    def list(self, folder: str, recursive: bool = False, suffix: str = "") -> List[ObjectInfo]:
+        """Return the metadata of the files in folder whose name ends with suffix, sorted by path"""
+
+    def versions(self, folder: str) -> List[str]:
+        """
+            Return '<path>#<generation or modified time>' for every file in folder (not recursive)
+            Used to check if a folder changed, backends override it when they can list this cheaper than list()
+        """
+        return [f"{o.path}#{o.generation or o.modified}" for o in self.list(folder)]
+
+    def bulk_list(self, folders: Iterable[str]) -> List[ObjectInfo]:
+        """Return the metadata of every file under any of folders (recursively), sorted by path"""
+        files = {}
+        for folder in sorted(set(folders)):
+            files.update((o.path, o) for o in self.list(folder, recursive=True))
+        return [files[path] for path in sorted(files)]
+
+
+def _gcs_date(timestamp: str) -> str:
+    """Convert a GCS JSON API timestamp (2025-02-20T18:27:17.123Z) to the gsutil format (Thu, 20 Feb 2025 18:27:17 GMT)"""
+    return format_datetime(datetime.fromisoformat(timestamp.replace("Z", "+00:00")).astimezone(timezone.utc).replace(microsecond=0), usegmt=True)
+
+
+def _split_gcs_path(path: str):
+    """gs://bucket/a/b -> (bucket, a/b)"""
+    bucket, _, name = path[len("gs://"):].partition("/")
+    return bucket, name
+
+
+class GsutilBackend(StorageBackend):
+    """GCS through the gsutil CLI, one subprocess per lookup"""
+
+    def _run(self, *args: str) -> str:
+        with METRICS.call("gsutil", args[0], target=args[-1]):
+            result = subprocess.run(["gsutil", *args], capture_output=True, text=True)
+        if result.returncode != 0:
+            raise StorageError(f"gsutil {' '.join(args)} failed: {result.stderr}")
+        return result.stdout
+
+    @staticmethod
+    def _object_info(path: str, data: Dict[str, str]) -> ObjectInfo:
+        # <path>:
+        #     Creation time:          Thu, 20 Feb 2025 18:27:17 GMT
+        #     Update time:            Thu, 20 Feb 2025 18:27:17 GMT
+        #     Storage class:          STANDARD
+        #     Content-Length:         3354423528
+        #     Content-Type:           application/octet-stream
+        #     Metadata:
+        #         goog-reserved-file-mtime:1738202406
+        #     Hash (crc32c):          YeC9gg==
+        #     Hash (md5):             skySRE+gMILYnhNWuLR0Eg==
+        #     ETag:                   CKuVxbDw0osDEAE=
+        #     Generation:             1740076036999851
+        #     Metageneration:         1
+        return ObjectInfo(
+            path=path,
+            md5=base64.b64decode(data["Hash (md5)"]).hex() if "Hash (md5)" in data else None,
+            size=int(data["Content-Length"]) if "Content-Length" in data else None,
+            created=data.get("Creation time"),
+            modified=data.get("Update time"),
+            generation=data.get("Generation"),
+            metageneration=data.get("Metageneration"),
+            etag=data.get("ETag"),
+        )
+
+    def stat(self, path: str) -> ObjectInfo:
+        objects = parse_gsutil_listing(self._run("stat", path))
+        if not objects:
+            raise StorageError(f"No such object: {path}")
+        return self._object_info(*next(iter(objects.items())))
+
+    def list(self, folder: str, recursive: bool = False, suffix: str = "") -> List[ObjectInfo]:
+        pattern = f"{folder}**{suffix}" if recursive else folder
+        objects = []
+        for path, data in parse_gsutil_listing(self._run("ls", "-L", pattern)).items():
+            # Sub-folders are listed without any fields
+            if data and path.endswith(suffix):
+                objects.append(self._object_info(path, data))
+        return sorted(objects, key=lambda o: o.path)
+
+    def versions(self, folder: str) -> List[str]:
+        # gsutil ls -a only lists the object names with their generation, sub-folders have no generation:
+        # gs://acp-coe-models-checkpoints-prod-0/version/0.1.0/pefs-checkpoints/ckpts/Llama-Guard-3-8B/.gitattributes#1731621618412036
+        return sorted(line.strip() for line in self._run("ls", "-a", folder).splitlines() if "#" in line)
+
+
+class GcsApiBackend(StorageBackend):
+    """
+        GCS through the JSON API, over a single authorized session that keeps its connections open between lookups
+        Uses the application default credentials (gcloud auth application-default login, or a service account)
+        Needs requests and google-auth, see requirements.txt
+    """
+
+    def __init__(self, pool_size: int = STORAGE_POOL_SIZE):
+        # Only needed for this backend, the CLI fallback works without them
+        import google.auth
+        from google.auth.transport.requests import AuthorizedSession
+        from requests.adapters import HTTPAdapter
+
+        credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/devstorage.read_only"])
+        self.session = AuthorizedSession(credentials)
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=3))
+
+    def _get(self, url: str, params: Dict) -> Dict:
+        with METRICS.call("gcs_api", "GET", target=url):
+            response = self.session.get(url, params=params, timeout=60)
+        if response.status_code != 200:
+            raise StorageError(f"GET {url} failed with {response.status_code}: {response.text}")
+        return response.json()
+
+    @staticmethod
+    def _object_info(bucket: str, item: Dict) -> ObjectInfo:
+        return ObjectInfo(
+            path=f"gs://{bucket}/{item['name']}",
+            md5=base64.b64decode(item["md5Hash"]).hex() if "md5Hash" in item else None,
+            size=int(item["size"]) if "size" in item else None,
+            created=_gcs_date(item["timeCreated"]) if "timeCreated" in item else None,
+            modified=_gcs_date(item["updated"]) if "updated" in item else None,
+            generation=item.get("generation"),
+            metageneration=item.get("metageneration"),
+            etag=item.get("etag"),
+        )
+
+    def _list_items(self, folder: str, recursive: bool, fields: str) -> List[Dict]:
+        bucket, prefix = _split_gcs_path(folder)
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+        params = {"prefix": prefix, "fields": f"items({fields}),nextPageToken", "maxResults": 1000}
+        if not recursive:
+            params["delimiter"] = "/"
+        items = []
+        while True:
+            page = self._get(f"{GCS_API}/b/{bucket}/o", params)
+            items.extend(page.get("items", []))
+            if "nextPageToken" not in page:
+                return items
+            params["pageToken"] = page["nextPageToken"]
+
+    def stat(self, path: str) -> ObjectInfo:
+        bucket, name = _split_gcs_path(path)
+        item = self._get(f"{GCS_API}/b/{bucket}/o/{quote(name, safe='')}", {"fields": GCS_FIELDS})
+        return self._object_info(bucket, item)
+
+    def list(self, folder: str, recursive: bool = False, suffix: str = "") -> List[ObjectInfo]:
+        bucket, _ = _split_gcs_path(folder)
+        items = self._list_items(folder, recursive, GCS_FIELDS)
+        objects = [self._object_info(bucket, item) for item in items if item["name"].endswith(suffix)]
+        return sorted(objects, key=lambda o: o.path)
+
+    def versions(self, folder: str) -> List[str]:
+        bucket, _ = _split_gcs_path(folder)
+        return sorted(f"gs://{bucket}/{item['name']}#{item['generation']}" for item in self._list_items(folder, False, "name,generation"))
+
+
+class JfrogCliBackend(StorageBackend):
+    """Artifactory through the jf CLI, one subprocess per lookup"""
+
+    def _search(self, *args: str) -> List[ObjectInfo]:
+        # [
+        #   {
+        #     "path": "sw-generic-daas-artifacts-dev/inference-engine/2025/pefs/deepseek-r1-16k-fp8-pef-v3/bs1/coe_pef/sncprof.json.gz",
+        #     "type": "file",
+        #     "size": 11590862,
+        #     "created": "2025-03-26T13:53:39.342-07:00",
+        #     "modified": "2025-03-26T13:53:39.221-07:00",
+        #     "sha1": "676cc424ff69a54a2bea4135176085ae275250da",
+        #     "sha256": "c64a33338be0b6bc5219b387ae76998f8d8017d99b01823b1a6e16e0a9928868",
+        #     "md5": "a2334cef8b358cc35f3b96b30b13509e"
+        #   },
+        # ...
+        with METRICS.call("jf", "rt s", target=args[0]):
+            result = subprocess.run(["jf", "rt", "s", *args], capture_output=True, text=True)
+        if result.returncode != 0:
+            raise StorageError(f"jf rt s {' '.join(args)} failed: {result.stderr}")
+        files = [
+            ObjectInfo(
+                path=f["path"], md5=f.get("md5"), size=f.get("size"), created=f.get("created"),
+                modified=f.get("modified"), sha256=f.get("sha256"),
+            )
+            for f in json.loads(result.stdout)
+        ]
+        return sorted(files, key=lambda o: o.path)
+
+    def stat(self, path: str) -> ObjectInfo:
+        files = self._search(path, "--recursive=false")
+        if not files:
+            raise StorageError(f"No such file: {path}")
+        return files[0]
+
+    def list(self, folder: str, recursive: bool = False, suffix: str = "") -> List[ObjectInfo]:
+        args = [folder] if recursive else [folder, "--recursive=false"]
+        return [o for o in self._search(*args) if o.path.endswith(suffix)]
+
+    def bulk_list(self, folders: Iterable[str]) -> List[ObjectInfo]:
+        """Search all folders with a single AQL query instead of one jf rt s per folder"""
+        folders = sorted(set(folders))
+        if not folders:
+            return []
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as spec_file:
+            json.dump(build_search_spec(folders), spec_file)
+            spec_file.flush()
+            print(f"Searching artifactory for {len(folders)} folders")
+            return self._search("--spec", spec_file.name)
+
+
+class ArtifactoryApiBackend(StorageBackend):
+    """
+        Artifactory through its REST API, over a single session that keeps its connections open between lookups
+        Needs ARTIFACTORY_URL (e.g. https://artifacts.example.com/artifactory), ARTIFACTORY_ACCESS_TOKEN and requests, see requirements.txt
+    """
+
+    def __init__(self, url: str, token: str, pool_size: int = STORAGE_POOL_SIZE):
+        # Only needed for this backend, the CLI fallback works without it
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {token}"
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=3))
+
+    @classmethod
+    def from_env(cls) -> "ArtifactoryApiBackend":
+        url, token = os.environ.get("ARTIFACTORY_URL"), os.environ.get("ARTIFACTORY_ACCESS_TOKEN")
+        if not url or not token:
+            raise StorageError("ARTIFACTORY_URL and ARTIFACTORY_ACCESS_TOKEN must be set to use the artifactory API")
+        return cls(url, token)
+
+    def _aql(self, criteria: List[Dict]) -> List[ObjectInfo]:
+        query = (
+            f'items.find({json.dumps({"$or": criteria})})'
+            '.include("repo","path","name","size","created","modified","sha256","actual_md5")'
+        )
+        with METRICS.call("artifactory_api", "POST", target="/api/search/aql"):
+            response = self.session.post(f"{self.url}/api/search/aql", data=query, headers={"Content-Type": "text/plain"}, timeout=120)
+        if response.status_code != 200:
+            raise StorageError(f"AQL search failed with {response.status_code}: {response.text}")
+        files = []
+        for item in response.json()["results"]:
+            # Files at the root of a repo have path '.'
+            path = "/".join(p for p in (item["repo"], item["path"], item["name"]) if p != ".")
+            files.append(ObjectInfo(
+                path=path, md5=item.get("actual_md5"), size=item.get("size"), created=item.get("created"),
+                modified=item.get("modified"), sha256=item.get("sha256"),
+            ))
+        return sorted(files, key=lambda o: o.path)
+
+    def stat(self, path: str) -> ObjectInfo:
+        with METRICS.call("artifactory_api", "GET", target=path):
+            response = self.session.get(f"{self.url}/api/storage/{quote(path)}", timeout=60)
+        if response.status_code != 200:
+            raise StorageError(f"Artifactory stat of {path} failed with {response.status_code}: {response.text}")
+        info = response.json()
+        return ObjectInfo(
+            path=path, md5=info["checksums"].get("md5"), size=int(info["size"]), created=info.get("created"),
+            modified=info.get("lastModified"), sha256=info["checksums"].get("sha256"),
+        )
+
+    def list(self, folder: str, recursive: bool = False, suffix: str = "") -> List[ObjectInfo]:
+        return [o for o in self._aql(search_criteria([folder], recursive)) if o.path.endswith(suffix)]
+
+    def bulk_list(self, folders: Iterable[str]) -> List[ObjectInfo]:
+        folders = sorted(set(folders))
+        if not folders:
+            return []
+        print(f"Searching artifactory for {len(folders)} folders")
+        return self._aql(search_criteria(folders))
+
+
+class LocalBackend(StorageBackend):
+    """
+        Offline stand-in for GCS and artifactory, backed by a local directory:
+        gs://bucket/a/b is read from <root>/gs/bucket/a/b, and repo/a/b from <root>/artifactory/repo/a/b
+        Generations and modified times come from the files' mtimes, md5sums are computed from their contents
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def _local_path(self, path: str) -> Path:
+        if path.startswith("gs://"):
+            return self.root / "gs" / path[len("gs://"):]
+        return self.root / "artifactory" / path
+
+    def _remote_path(self, local_path: Path) -> str:
+        kind, *parts = local_path.relative_to(self.root).parts
+        return ("gs://" if kind == "gs" else "") + "/".join(parts)
+
+    def _object_info(self, local_path: Path) -> ObjectInfo:
+        path = self._remote_path(local_path)
+        md5, sha256 = hashlib.md5(), hashlib.sha256()
+        with open(local_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                md5.update(chunk)
+                sha256.update(chunk)
+        stat = local_path.stat()
+        mtime = datetime.fromtimestamp(stat.st_mtime, timezone.utc).replace(microsecond=0)
+        if path.startswith("gs://"):
+            return ObjectInfo(
+                path=path, md5=md5.hexdigest(), size=stat.st_size, created=format_datetime(mtime, usegmt=True),
+                modified=format_datetime(mtime, usegmt=True), generation=str(stat.st_mtime_ns), metageneration="1",
+                etag=md5.hexdigest(),
+            )
+        return ObjectInfo(
+            path=path, md5=md5.hexdigest(), size=stat.st_size, created=mtime.isoformat(),
+            modified=mtime.isoformat(), sha256=sha256.hexdigest(),
+        )
+
+    def stat(self, path: str) -> ObjectInfo:
+        local_path = self._local_path(path)
+        if not local_path.is_file():
+            raise StorageError(f"No such file: {path}")
+        return self._object_info(local_path)
+
+    def list(self, folder: str, recursive: bool = False, suffix: str = "") -> List[ObjectInfo]:
+        local_folder = self._local_path(folder)
+        if not local_folder.is_dir():
+            return []
+        children = local_folder.rglob("*") if recursive else local_folder.iterdir()
+        objects = [self._object_info(p) for p in children if p.is_file() and p.name.endswith(suffix)]
+        return sorted(objects, key=lambda o: o.path)
+
+
+_BACKENDS_LOCK = threading.Lock()
+# "gcs" / "artifactory" -> backend, created on first use and shared by all threads
+_BACKENDS: Dict[str, StorageBackend] = {}
+
+def _create_backend(kind: str) -> StorageBackend:
+    if STORAGE_BACKEND == "local":
+        if not STORAGE_LOCAL_ROOT:
+            raise StorageError("STORAGE_LOCAL_ROOT must be set to use the local storage backend")
+        return LocalBackend(Path(STORAGE_LOCAL_ROOT))
+    if STORAGE_BACKEND in ("auto", "api"):
+        try:
+            return GcsApiBackend() if kind == "gcs" else ArtifactoryApiBackend.from_env()
+        except Exception as e:
+            if STORAGE_BACKEND == "api":
+                raise
+            if isinstance(e, ImportError):
+                reason = f"its dependencies are not installed ({e}), pip install -r requirements.txt"
+            else:
+                # e.g. no application default credentials, or ARTIFACTORY_URL / ARTIFACTORY_ACCESS_TOKEN not set
+                reason = f"it could not be set up, {type(e).__name__}: {e}"
+            print(f"Using the {kind} CLI instead of the {kind} API client, {reason}. Set STORAGE_BACKEND=api to fail instead")
+    return GsutilBackend() if kind == "gcs" else JfrogCliBackend()
+
+def get_backend(path: str) -> StorageBackend:
+    """Return the backend for the storage path is in, gs:// paths are in GCS and everything else in artifactory"""
+    kind = "gcs" if path.startswith("gs://") else "artifactory"
+    with _BACKENDS_LOCK:
+        if kind not in _BACKENDS:
+            _BACKENDS[kind] = _create_backend(kind)
+        return _BACKENDS[kind]
@@ -0,0 +1,186 @@
+"""
+    Generate a synthetic fleet for scale testing: deployment yamls, cluster tfvars and a studio GTM csv
+    The output directory is laid out like the real checkouts:
+        <out>/fast-coe/helm/inference-deployments/prod/*.yaml
+        <out>/fast-coe/helm/values.yaml
+        <out>/sn_iac/environments/production/terraform/modules/sn_vcluster_tenant_v2/tfvars/*.tfvars
+        <out>/daas-release/inventory/inventory_output/prod/models_and_pefs_gtm.csv
+        <out>/model_arch_mappings.yaml and <out>/sn_iac_clusters.yaml
+    Experts, PEFs and checkpoints are shared between deployments the way they are in prod,
+    so the cloud configs get merged and only part of the keys are in both inventories
+
+    Usage: python synthetic_inventory.py --deployments 1000 --out /tmp/fleet [--seed 0]
+"""
+import argparse
+import csv
+import random
+import zlib
+from pathlib import Path
+from typing import Dict, List
+
+import yaml
+
+from utils import MAX_SEQ_LEN_MAP
+
+CLUSTER_TFVARS = Path("sn_iac/environments/production/terraform/modules/sn_vcluster_tenant_v2/tfvars")
+DEPLOYMENTS_DIR = Path("fast-coe/helm/inference-deployments/prod")
+VALUES_YAML = Path("fast-coe/helm/values.yaml")
+STUDIO_INVENTORY = Path("daas-release/inventory/inventory_output/prod/models_and_pefs_gtm.csv")
+MODEL_MAPPINGS = Path("model_arch_mappings.yaml")
+CLUSTERS_FILE = Path("sn_iac_clusters.yaml")
+
+BATCH_SIZES = [1, 2, 4, 8, 16, 32]
+# Studio rows for other architectures and modes, not compared with the cloud
+OTHER_STUDIO_TARGETS = [
+    {"mode": "infer", "rdu_arch": "sn40-8", "model_parallel_rdus": 8},
+    {"mode": "infer", "rdu_arch": "sn30-8", "model_parallel_rdus": 8},
+    {"mode": "train", "rdu_arch": "sn40-16", "model_parallel_rdus": 16},
+]
+STUDIO_FIELDS = ["mode", "rdu_arch", "model_parallel_rdus", "model_app_name", "model_parameter_count", "spec_decoding",
+                 "max_seq_length", "batch_sizes", "pef_path", "model_path", "model_checkpoint_name", "vocab_size"]
+
+Dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+
+def _model_mappings(num_models: int, num_drafts: int) -> Dict[str, Dict]:
+    mappings = {}
+    for m in range(num_models):
+        mappings[f"Synth-Model-{m:05d}"] = {"app_name": f"Samba1 Synth{m:05d} Experts", "model_parameter_count": f"{m % 70 + 1}b"}
+    for d in range(num_drafts):
+        mappings[f"Synth-Draft-{d:03d}"] = {"app_name": f"Samba1 SynthDraft{d:03d} Experts", "model_parameter_count": "1b"}
+    return mappings
+
+
+def _expert(name: str, seq_len: str, batch_sizes: List[int], deployment: Dict):
+    """Add the expert, its PEFs and checkpoint to a deployment spec. PEF and checkpoint sources only depend on the expert"""
+    spec = deployment["spec"]
+    checkpoint = f"ck-{name}"
+    spec["checkpoints"][checkpoint] = {"source": f"gs://synthetic-checkpoints/ckpts/{name}"}
+    experts = []
+    for bs in batch_sizes:
+        pef = f"pef-{name}-{seq_len}-bs{bs}"
+        spec["pefs"][pef] = {"source": f"gs://synthetic-pefs/pefs/PEF_{zlib.crc32(pef.encode()) % 10000}/{name}-{seq_len}/bs{bs}/{name}.pef"}
+        experts.append({"batch_size": bs, "pef": pef, "checkpoint": checkpoint, "ckpt_sharing": True})
+    spec["experts"][f"{name}-{seq_len}"] = experts
+
+
+def generate(out: Path, num_deployments: int, seed: int = 0, num_clusters: int = 3, inactive_ratio: float = 0.1,
+             studio_ratio: float = 0.6, unfiltered_ratio: float = 0.0) -> Dict[str, int]:
+    """
+        Write a synthetic fleet of num_deployments active deployments (plus inactive ones) to out
+        studio_ratio of the cloud configs are also in the studio inventory, with some batch sizes added or removed
+        The studio inventory also gets unfiltered_ratio times as many rows for other architectures and modes, which the comparison skips
+        Returns the number of files / rows written
+    """
+    # Same seed, same fleet. Python's hash() is randomized per process, so it isn't used for anything that is written
+    rng = random.Random(seed)
+    num_models = max(4, num_deployments // 4)
+    num_drafts = max(1, num_models // 20)
+    seq_lens = list(MAX_SEQ_LEN_MAP.values())
+    mappings = _model_mappings(num_models, num_drafts)
+    models = [m for m in mappings if m.startswith("Synth-Model")]
+    drafts = [m for m in mappings if m.startswith("Synth-Draft")]
+
+    deployments_dir = out / DEPLOYMENTS_DIR
+    deployments_dir.mkdir(parents=True, exist_ok=True)
+    # (model, seq len, sd) -> batch sizes, to build the studio inventory from
+    cloud_configs = {}
+    names = [f"synthetic-deployment-{i:05d}" for i in range(num_deployments + int(num_deployments * inactive_ratio))]
+    for name in names:
+        deployment = {
+            "apiVersion": "v1",
+            "kind": "InferenceDeployment",
+            "metadata": {"name": name},
+            "spec": {"environmentSecretNames": ["synthetic"], "pefs": {}, "checkpoints": {}, "experts": {}, "speculative_decoding": []},
+        }
+        for model in rng.sample(models, rng.randint(1, min(4, len(models)))):
+            seq_len = rng.choice(seq_lens)
+            batch_sizes = sorted(rng.sample(BATCH_SIZES, rng.randint(1, 3)))
+            _expert(model, seq_len, batch_sizes, deployment)
+            sd = rng.random() < 0.3
+            if sd:
+                draft = rng.choice(drafts)
+                _expert(draft, seq_len, [1], deployment)
+                deployment["spec"]["speculative_decoding"].append(
+                    {"batch_size": 1, "k": 4, "draft_model": f"{draft}-{seq_len}", "target_model": f"{model}-{seq_len}"}
+                )
+            cloud_configs.setdefault((model, seq_len, sd), set()).update(batch_sizes)
+        with open(deployments_dir / f"{name}.yaml", "w") as f:
+            yaml.dump(deployment, f, Dumper=Dumper, sort_keys=False)
+
+    # Active deployments are spread over the clusters, the rest are inactive
+    active = names[:num_deployments]
+    tfvars_dir = out / CLUSTER_TFVARS
+    tfvars_dir.mkdir(parents=True, exist_ok=True)
+    clusters = [f"synthetic-cluster-{c}" for c in range(num_clusters)]
+    for c, cluster in enumerate(clusters):
+        coe_values = yaml.dump({"inferenceDeploymentSpecs": [{"name": n, "replicas": 1} for n in active[c::num_clusters]]}, Dumper=Dumper)
+        heredoc = "".join(f"  {line}\n" for line in coe_values.splitlines())
+        (tfvars_dir / f"{cluster}.tfvars").write_text(f'cluster_name = "{cluster}"\ncoe_values = <<EOVAL\n{heredoc}  EOVAL\n')
+
+    studio_rows = []
+    for (model, seq_len, sd), batch_sizes in sorted(cloud_configs.items()):
+        if rng.random() >= studio_ratio:
+            continue
+        studio_rows.append(_studio_row(model, mappings[model], seq_len, sd, batch_sizes, rng))
+    # Studio-only configs, with sequence lengths no deployment uses for that model
+    for model in rng.sample(models, max(1, len(models) // 10)):
+        seq_len = rng.choice(seq_lens)
+        if (model, seq_len, False) not in cloud_configs:
+            studio_rows.append(_studio_row(model, mappings[model], seq_len, False, {1}, rng))
+    compared_rows = len(studio_rows)
+    for _ in range(int(compared_rows * unfiltered_ratio)):
+        row = dict(rng.choice(studio_rows[:compared_rows]))
+        row.update(rng.choice(OTHER_STUDIO_TARGETS))
+        studio_rows.append(row)
+
+    studio_file = out / STUDIO_INVENTORY
+    studio_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(studio_file, "w") as f:
+        writer = csv.DictWriter(f, fieldnames=STUDIO_FIELDS)
+        writer.writeheader()
+        writer.writerows(studio_rows)
+
+    (out / VALUES_YAML).write_text("models: {}\n")
+    with open(out / MODEL_MAPPINGS, "w") as f:
+        yaml.dump(mappings, f, Dumper=Dumper)
+    with open(out / CLUSTERS_FILE, "w") as f:
+        yaml.dump({"production": clusters}, f, Dumper=Dumper)
+
+    return {"deployments": len(names), "active_deployments": len(active), "cloud_configs": len(cloud_configs), "studio_rows": len(studio_rows)}
+
+
+def _studio_row(model: str, mapping: Dict, seq_len: str, sd: bool, batch_sizes, rng: random.Random) -> Dict:
+    batch_sizes = set(batch_sizes)
+    # Studio often lags behind or is ahead of the cloud by a batch size
+    if rng.random() < 0.3:
+        batch_sizes.add(rng.choice(BATCH_SIZES))
+    max_seq_length = {v: k for k, v in MAX_SEQ_LEN_MAP.items()}[seq_len]
+    app_folder = mapping["app_name"].replace(" ", "_")
+    return {
+        "mode": "infer",
+        "rdu_arch": "sn40-16",
+        "model_parallel_rdus": 16,
+        "model_app_name": mapping["app_name"],
+        "model_parameter_count": mapping["model_parameter_count"],
+        "spec_decoding": sd,
+        "max_seq_length": max_seq_length,
+        "batch_sizes": sorted(batch_sizes),
+        "pef_path": f"{{{{ARTIFACTS_REPO}}}}/inference-engine/pefs/{app_folder}-{mapping['model_parameter_count']}-{sd}-{max_seq_length}/",
+        "model_path": f"{{{{ARTIFACTS_REPO}}}}/checkpoints/{model}/",
+        "model_checkpoint_name": model,
+        "vocab_size": 128256,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--deployments", type=int, default=1000)
+    parser.add_argument("--out", type=Path, required=True)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--unfiltered-ratio", type=float, default=0.0, help="Studio rows for other architectures and modes, per compared studio row")
+    args = parser.parse_args()
+
+    counts = generate(args.out, args.deployments, seed=args.seed, unfiltered_ratio=args.unfiltered_ratio)
+    print(f"Wrote {counts['deployments']} deployments ({counts['active_deployments']} active, {counts['cloud_configs']} cloud configs) "
+          f"and {counts['studio_rows']} studio rows to {args.out}")
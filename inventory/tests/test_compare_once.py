@@ -0,0 +1,122 @@
+"""
+    InventoryComparer computes every comparison once and shares it across all the outputs (see InventoryComparer.compare)
+    Runs the whole comparison on a small synthetic fleet, with GCS served by LocalBackend from a temporary folder
+"""
+import csv
+from collections import Counter
+from pathlib import Path
+
+import pytest
+
+import cloud_inventory
+import compare_inventories
+import compare_models
+import compare_pefs
+import storage
+import tfvars
+import utils
+import yaml_snapshot
+from compare_inventories import InventoryComparer
+from metadata_cache import MetadataCache
+from storage import LocalBackend
+from synthetic_inventory import generate, CLUSTER_TFVARS, DEPLOYMENTS_DIR, MODEL_MAPPINGS, STUDIO_INVENTORY, VALUES_YAML
+
+# Studio artifacts are moved from artifactory to this bucket, so every PEF goes through the per-path lookups
+STUDIO_BUCKET = "gs://synthetic-studio"
+
+
+def _write(root: Path, path: str, content: str):
+    local_path = root / "gs" / path[len("gs://"):]
+    local_path.parent.mkdir(parents=True, exist_ok=True)
+    local_path.write_text(content)
+
+
+@pytest.fixture
+def fleet(tmp_path, monkeypatch):
+    """Return the cloud configs of a synthetic fleet, with all of its PEFs and checkpoints in local storage"""
+    fleet = tmp_path / "fleet"
+    generate(fleet, 8)
+    studio_file = fleet / STUDIO_INVENTORY
+    with open(studio_file) as f:
+        reader = csv.DictReader(f)
+        fields, studio_rows = reader.fieldnames, list(reader)
+    for row in studio_rows:
+        row["pef_path"] = row["pef_path"].replace("{{ARTIFACTS_REPO}}", STUDIO_BUCKET)
+        row["model_path"] = row["model_path"].replace("{{ARTIFACTS_REPO}}", STUDIO_BUCKET)
+    with open(studio_file, "w") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(studio_rows)
+
+    monkeypatch.setattr(yaml_snapshot, "SNAPSHOTS_ENABLED", False)
+    monkeypatch.setattr(utils.CONFIG, "_loaders", dict(utils.CONFIG._loaders))
+    monkeypatch.setattr(utils.CONFIG, "_values", {})
+    utils.CONFIG.register("model_mappings", lambda: utils.load_yaml(fleet / MODEL_MAPPINGS))
+    utils.CONFIG.register("cloud_models", lambda: utils.load_yaml(fleet / VALUES_YAML)["models"])
+    utils.CONFIG.register("cloud_studio_model_mappings", lambda: {})
+    monkeypatch.setattr(cloud_inventory, "MAX_WORKERS", 1)
+    active = set()
+    for cluster_file in (fleet / CLUSTER_TFVARS).iterdir():
+        active.update(tfvars.read_cluster_deployments(cluster_file))
+    configs = cloud_inventory.get_cloud_configs(cloud_inventory.load_deployments(active, deployments_dir=fleet / DEPLOYMENTS_DIR))
+
+    storage_root = tmp_path / "storage"
+    for config in configs.values():
+        record = config.to_record()
+        for pef in record["cloud_pefs_json"].values():
+            _write(storage_root, pef["pef_path"], pef["pef_path"])
+        for model_path in record["cloud_models"].values():
+            _write(storage_root, f"{model_path}/model.safetensors", model_path)
+    for row in studio_rows:
+        for bs in row["batch_sizes"].strip("[]").split(","):
+            _write(storage_root, f"{compare_pefs.get_studio_pef_folder(row['pef_path'], int(bs))}model.pef", row["pef_path"])
+        _write(storage_root, f"{row['model_path']}model.safetensors", row["model_path"])
+
+    # Both storage kinds are served from the local folder, nothing is in artifactory since the studio artifacts were moved to GCS
+    backend = LocalBackend(storage_root)
+    monkeypatch.setattr(storage, "_BACKENDS", {"gcs": backend, "artifactory": backend})
+    # Every PEF is looked up on its own instead of with a prefix listing, so each lookup shows in FETCH_COUNTS
+    monkeypatch.setattr(compare_pefs, "PREFIX_LISTING_MIN_PATHS", float("inf"))
+    for counts in ("LOOKUP_COUNTS", "FETCH_COUNTS"):
+        monkeypatch.setattr(compare_pefs, counts, Counter())
+    # The caches and the delta state are kept in the temporary folder instead of next to the scripts
+    manifest_cache = MetadataCache(tmp_path / "manifest_cache.sqlite")
+    for module, name, value in (
+        (compare_pefs, "CACHE", MetadataCache(tmp_path / "md5sum_cache.sqlite")),
+        (compare_models, "MANIFEST_CACHE", manifest_cache),
+        (compare_inventories, "MANIFEST_CACHE", manifest_cache),
+        (compare_inventories, "COMPARISON_CACHE", MetadataCache(tmp_path / "comparison_cache.sqlite")),
+        (compare_inventories, "DELTA_STATE_FILE", tmp_path / "delta_state.json"),
+        (compare_inventories, "STUDIO_INVENTORY_PATH", studio_file),
+    ):
+        monkeypatch.setattr(module, name, value)
+    monkeypatch.setattr(compare_models, "_LISTINGS", {})
+    # The outputs are written to output/ under the working directory
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "output").mkdir()
+    return configs
+
+
+def test_metadata_fetched_once_per_pef(fleet, monkeypatch):
+    common_rows_calls = []
+    common_rows = InventoryComparer._common_rows
+    def count_common_rows(self):
+        common_rows_calls.append(self)
+        return common_rows(self)
+    monkeypatch.setattr(InventoryComparer, "_common_rows", count_common_rows)
+
+    comparer = InventoryComparer(fleet)
+    comparer.write()
+
+    assert len(common_rows_calls) == 1
+    for _, _, filename in comparer.outputs():
+        assert Path(filename).exists()
+    pef_paths = {path for key in comparer.common_keys for pair in comparer._pef_pairs(key) for path in pair}
+    assert pef_paths, "the fleet should have common keys with PEFs to compare"
+    assert set(compare_pefs.FETCH_COUNTS) == pef_paths
+    assert all(compare_pefs.FETCH_COUNTS[path] == 1 for path in pef_paths), compare_pefs.FETCH_COUNTS
+    assert set(compare_pefs.LOOKUP_COUNTS) == pef_paths
+    assert all(compare_pefs.LOOKUP_COUNTS[path] == 1 for path in pef_paths), compare_pefs.LOOKUP_COUNTS
+    # A second compare() reuses the results instead of comparing again
+    assert comparer.compare() is comparer.compare()
+    assert len(common_rows_calls) == 1
@@ -0,0 +1,84 @@
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from itertools import takewhile
+from pathlib import Path
+from typing import Dict, List
+
+from utils import file_sha256
+from yaml_snapshot import parse_yaml
+
+# cluster tfvars path -> {"sha256": ..., "deployments": [...]}, so unchanged tfvars files aren't parsed again
+CACHE_FILE = Path(__file__).parent / ".tfvars_cache.json"
+
+
+def extract_heredoc(text: str, marker: str = "EOVAL") -> str:
+    """
+        Return the contents of the first heredoc delimited by marker in a .tfvars file, un-indented
+        e.g. coe_values = <<EOVAL ... EOVAL
+        The heredoc is indented in the .tfvars file, the indentation of its first line is removed from every line
+    """
+    lines = iter(text.splitlines(keepends=True))
+    # Skip to the beginning of the heredoc
+    for line in lines:
+        if marker in line:
+            break
+    else:
+        raise ValueError(f"No {marker} heredoc found")
+
+    content = []
+    indent = None
+    for line in lines:
+        if marker in line:
+            return "".join(content)
+        if indent is None:
+            indent = len(''.join(takewhile(str.isspace, line)))
+        content.append(line[indent:])
+    raise ValueError(f"Unterminated {marker} heredoc")
+
+
+def read_cluster_deployments(cluster_file: Path) -> List[str]:
+    """Return the names of the inference deployments in the coe-values heredoc of a cluster's .tfvars file"""
+    with open(cluster_file) as f:
+        coe_values = parse_yaml(extract_heredoc(f.read()))
+    return [d["name"] for d in coe_values['inferenceDeploymentSpecs']]
+
+
+def _load_cache() -> Dict:
+    try:
+        with open(CACHE_FILE) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _save_cache(cache: Dict):
+    fd, tmp_file = tempfile.mkstemp(dir=CACHE_FILE.parent, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, CACHE_FILE)
+
+
+def get_cluster_deployments(cluster_files: Dict[str, Path]) -> Dict[str, List[str]]:
+    """
+        Return cluster name -> names of the inference deployments running on that cluster
+        Cluster files are read in parallel, and files whose hash matches the cached entry are not parsed again
+    """
+    cache = _load_cache()
+
+    def cluster_deployments(cluster_file: Path) -> List[str]:
+        sha256 = file_sha256(cluster_file)
+        entry = cache.get(str(cluster_file))
+        if entry is not None and entry["sha256"] == sha256:
+            return entry["deployments"]
+        deployments = read_cluster_deployments(cluster_file)
+        cache[str(cluster_file)] = {"sha256": sha256, "deployments": deployments}
+        return deployments
+
+    clusters = list(cluster_files.keys())
+    with ThreadPoolExecutor(max_workers=max(1, min(len(clusters), 8))) as executor:
+        results = list(executor.map(cluster_deployments, [cluster_files[c] for c in clusters]))
+
+    _save_cache(cache)
+    return dict(zip(clusters, results))
@@ -1,31 +1,110 @@
 import re
-import yaml
+import os
+import hashlib
+import threading
 from pathlib import Path
-from typing import Union, Dict, List
+from typing import Union, Dict, List, Callable, Any, Iterable, Iterator
 import csv
+import json
+
+from yaml_snapshot import load_yaml_snapshot
 
 DAAS_RELEASE_ROOT = Path(__file__).parent.parent.parent / "daas-release"
 FAST_COE_ROOT = Path(__file__).parent.parent.parent / "fast-coe"
 SN_IAC_ROOT = Path(__file__).parent.parent.parent / "sn_iac"
 
 SN_IAC_PROD = SN_IAC_ROOT / "environments" / "production" / "terraform" / "modules" / "sn_vcluster_tenant_v2" / "tfvars"
-SN_IAC_PROD_CLUSTER_FILES = [SN_IAC_PROD / f"{cluster_name}.tfvars" for cluster_name in 
-    [
-        "fast-snova-ai-jp-prod-2",
-        "fast-snova-ai-prod-0",
-        "fast-snova-ai-prod-1",
-    ]
-]
+# Clusters to read active deployments from, per sn_iac environment
+CLUSTERS_FILE = Path(__file__).parent / "sn_iac_clusters.yaml"
 
 STUDIO_INVENTORY_PATH= DAAS_RELEASE_ROOT / "inventory/inventory_output/prod/models_and_pefs_gtm.csv"
+# Outputs of cloud_inventory.py
+CLOUD_INVENTORY_PATH = Path(__file__).parent / "output/cloud_inventory.csv"
+CLOUD_INVENTORY_GTM_PATH = Path(__file__).parent / "output/cloud_inventory_gtm.csv"
 CLOUD_MODELS_YAML = FAST_COE_ROOT / "helm/values.yaml"
 CLOUD_PROD_DEPLOYMENTS = FAST_COE_ROOT / "helm/inference-deployments/prod"
 
 MODEL_MAPPINGS_FILE = Path(__file__).parent / "model_arch_mappings.yaml"
-with open(MODEL_MAPPINGS_FILE) as f:
-    MODEL_MAPPINGS=yaml.safe_load(f)
-with open(CLOUD_MODELS_YAML) as f:
-    CLOUD_MODELS = yaml.safe_load(f)["models"]
+
+
+class LazyConfig():
+    """
+        Registry of configuration files that are only read and parsed the first time they are used
+        Register a loader under a name with register(), then get() the value wherever it's needed
+    """
+    def __init__(self):
+        self._loaders: Dict[str, Callable] = {}
+        self._values: Dict[str, Any] = {}
+        self._lock = threading.RLock()
+
+    def register(self, name: str, loader: Callable):
+        """Register a function that loads the config value for name"""
+        self._loaders[name] = loader
+
+    def get(self, name: str) -> Any:
+        """Return the config value for name, loading it on first use"""
+        if name not in self._values:
+            with self._lock:
+                if name not in self._values:
+                    self._values[name] = self._loaders[name]()
+        return self._values[name]
+
+    def reset(self, name: str = None):
+        """Forget the loaded value for name (or all values), so it is read again on next use"""
+        with self._lock:
+            if name is None:
+                self._values.clear()
+            else:
+                self._values.pop(name, None)
+
+
+def load_yaml(path):
+    """Parse a yaml file, reusing the parsed snapshot from a previous run if the file hasn't changed"""
+    return load_yaml_snapshot(path)
+
+
+CONFIG = LazyConfig()
+CONFIG.register("model_mappings", lambda: load_yaml(MODEL_MAPPINGS_FILE))
+CONFIG.register("cloud_models", lambda: load_yaml(CLOUD_MODELS_YAML)["models"])
+CONFIG.register("clusters", lambda: load_yaml(CLUSTERS_FILE))
+
+
+def get_tfvars_dir(environment: str = "production") -> Path:
+    """Return the folder of the cluster tfvars files of an sn_iac environment"""
+    return SN_IAC_ROOT / "environments" / environment / "terraform" / "modules" / "sn_vcluster_tenant_v2" / "tfvars"
+
+
+def get_cluster_files(environment: str = "production") -> Dict[str, Path]:
+    """Return cluster name -> tfvars file for the clusters of an sn_iac environment listed in CLUSTERS_FILE"""
+    known_clusters = CONFIG.get("clusters")
+    if environment not in known_clusters:
+        raise ValueError(f"Unknown sn_iac environment {environment}, {CLUSTERS_FILE.name} lists the clusters of: {', '.join(sorted(known_clusters))}")
+    clusters = known_clusters[environment]
+    if environment == "production" and os.environ.get("SN_IAC_PROD_CLUSTERS"):
+        clusters = [c.strip() for c in os.environ["SN_IAC_PROD_CLUSTERS"].split(",") if c.strip()]
+    tfvars_dir = get_tfvars_dir(environment)
+    return {cluster: tfvars_dir / f"{cluster}.tfvars" for cluster in clusters}
+
+
+# fast-coe deployment folder per sn_iac environment, other environments use helm/inference-deployments/<environment>
+CLOUD_DEPLOYMENTS_DIRS = {"production": CLOUD_PROD_DEPLOYMENTS}
+
+def get_deployments_dir(environment: str = "production") -> Path:
+    """Return the folder of the inference deployment files of an sn_iac environment"""
+    return CLOUD_DEPLOYMENTS_DIRS.get(environment, FAST_COE_ROOT / "helm/inference-deployments" / environment)
+
+
+# Module attributes that are loaded when first accessed
+_LAZY_ATTRIBUTES = {
+    "MODEL_MAPPINGS": lambda: CONFIG.get("model_mappings"),
+    "CLOUD_MODELS": lambda: CONFIG.get("cloud_models"),
+    "SN_IAC_PROD_CLUSTER_FILES": lambda: list(get_cluster_files("production").values()),
+}
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        return _LAZY_ATTRIBUTES[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 MAX_SEQ_LEN_MAP = {
     4096: "4k",
@@ -58,7 +137,7 @@ def convert_seq_len(seq_len, target_type=str) -> Union[str, int]:
 
 def lookup_seq_len(expert_name: str) -> int:
     """Lookup the seq len for an expert in the cloud helm chart"""
-    for model_name, model in CLOUD_MODELS.items():
+    for model_name, model in CONFIG.get("cloud_models").items():
         try:
             if model_name == expert_name or expert_name in model.get("aliases", {}):
                 # CLOUD_MODELS format:
@@ -123,7 +202,7 @@ def get_mapping(expert_name) -> Dict[str, str]:
         pass
 
     expert_name_norm = normalize_expert_name(expert_name)
-    expert_mapping = MODEL_MAPPINGS.get(expert_name_norm, None)
+    expert_mapping = CONFIG.get("model_mappings").get(expert_name_norm, None)
     if expert_mapping is None:
         raise UnknownExpertError(f"Could not find normalized expert name {expert_name_norm} in mappings file {MODEL_MAPPINGS_FILE}")
     return expert_mapping
@@ -144,14 +223,68 @@ def get_parameter_count(expert_name) -> str:
     return str(expert_mapping["model_parameter_count"])
 
 
+AF_REPO = "sw-generic-daas-artifacts-dev"
+
 def replace_af_prefix(inp: str) -> str:
     """Replace prefix variables from artifactory paths with their corresponding dev repo"""
-    inp = inp.replace("{{ARTIFACTS_REPO}}", "sw-generic-daas-artifacts-dev")
+    inp = inp.replace("{{ARTIFACTS_REPO}}", AF_REPO)
     return inp
 
+def parse_gsutil_listing(output: str) -> Dict[str, Dict[str, str]]:
+    """
+        Parse the output of gsutil stat / gsutil ls -L into a dict of object path -> {field: value}
+        Each object starts with an unindented '<path>:' line followed by indented '<field>: <value>' lines
+    """
+    objects = {}
+    fields = None
+    for line in output.splitlines():
+        if line.startswith("gs://"):
+            fields = objects.setdefault(line.strip().rstrip(":"), {})
+        elif fields is not None and line.strip():
+            # Lines after the last object (e.g. 'TOTAL: ...') are not indented
+            if not line[0].isspace():
+                fields = None
+                continue
+            line = line.strip()
+            key = line.split(":")[0]
+            val = ":".join(line.split(":")[1:]).strip()
+            fields[key] = val
+    return objects
+
+def file_sha256(path) -> str:
+    """Return the sha256 of a file's contents"""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
 def read_csv(csv_file) -> List[Dict]:
     """Return all the rows from a csv"""
     with open(csv_file) as f:
         reader = csv.DictReader(f)
         rows = [r for r in reader]
     return rows
+
+def jsonl_path(csv_file) -> Path:
+    """Return the path of the typed JSON-Lines output written alongside a csv output"""
+    return Path(csv_file).with_suffix(".jsonl")
+
+def write_jsonl(jsonl_file, rows: Iterable[Dict], fields: List[str]):
+    """
+        Write rows as JSON-Lines, one object per row with the given fields in order (missing fields are null)
+        Values keep their types: lists, dicts, ints and bools are written as such, not as their str() like in the csvs
+    """
+    with open(jsonl_file, "w") as f:
+        for row in rows:
+            f.write(json.dumps({field: row.get(field) for field in fields}, separators=(",", ":")))
+            f.write("\n")
+
+def read_jsonl(jsonl_file, columns: List[str] = None) -> Iterator[Dict]:
+    """
+        Yield the rows of a JSON-Lines file written by write_jsonl
+        If columns is given, only those fields are kept in each row (missing ones are None), the rest are dropped as each line is read
+    """
+    with open(jsonl_file) as f:
+        for line in f:
+            row = json.loads(line)
+            if columns is not None:
+                row = {column: row.get(column) for column in columns}
+            yield row
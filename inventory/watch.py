@@ -0,0 +1,266 @@
+"""
+    Long-running mode: keep the inventories up to date as fast-coe, sn_iac and daas-release change, and serve them over HTTP
+    The input files under DAAS_RELEASE_ROOT, FAST_COE_ROOT and SN_IAC_ROOT (and the mapping files next to this script)
+    are polled for changes. Parsed deployments stay in memory and only changed deployment files are parsed again,
+    common keys whose inputs haven't changed reuse their comparison (see InventoryComparer._reusable_comparisons),
+    the studio inventory is only read and prefetched again when its csv changes, and only the model pairs whose
+    checkpoint paths changed are compared again
+    Every --revalidate seconds, cached PEF metadata older than that (unless PEF_CACHE_TTL_GCS / PEF_CACHE_TTL_AF set
+    another TTL) and all checkpoint manifests are looked up again, and the comparisons that used them are redone
+    Every refresh writes the same outputs as pipeline.py, including the delta report
+
+    Endpoints (GET, JSON):
+        /status                 generation, last refresh time, changed files, row counts and the last error
+        /inventory/cloud        typed cloud inventory records
+        /inventory/studio       studio inventory rows compared with the cloud
+        /diff/<output>          rows of cloud_only, common, studio_only, onboard_to_studio or model_comparison
+        /delta                  rows added, removed or changed by the last refresh
+        /metrics                stage timings, remote calls and cache hit ratios of the last refresh
+    Rows can be filtered on any column with query parameters, e.g. /diff/common?model_app_name=Samba1_Llama_Experts
+
+    Usage: python watch.py [--host 127.0.0.1] [--port 8765] [--interval 5] [--revalidate 3600] [--quiet]
+"""
+import argparse
+import json
+import os
+import threading
+import time
+import traceback
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Set, Tuple
+from urllib.parse import urlsplit, parse_qsl
+
+import cloud_inventory
+import compare_models
+import compare_pefs
+import metrics
+from compare_inventories import InventoryComparer, prefetch_artifactory, read_studio_inventory, to_typed_row
+from metrics import METRICS, log
+from utils import CONFIG, CLUSTERS_FILE, CLOUD_MODELS_YAML, MODEL_MAPPINGS_FILE, STUDIO_INVENTORY_PATH, get_cluster_files, get_deployments_dir
+
+# Seconds between two polls of the input files
+POLL_INTERVAL = float(os.environ.get("WATCH_POLL_INTERVAL", 5))
+# Seconds the input files must stay unchanged before refreshing, so a checkout or pull is picked up as a whole
+SETTLE_TIME = float(os.environ.get("WATCH_SETTLE_TIME", 1))
+# Seconds after which PEF metadata and checkpoint manifests are revalidated, see InventoryWatcher
+REVALIDATE_INTERVAL = float(os.environ.get("WATCH_REVALIDATE_INTERVAL", 3600))
+
+# Files read through CONFIG, or that change how every deployment is turned into CloudConfigs
+CONFIG_INPUTS = [MODEL_MAPPINGS_FILE, CLOUD_MODELS_YAML, CLUSTERS_FILE, compare_models.MODEL_MAPPINGS_FILE]
+
+
+def file_state(path: Path):
+    """(mtime, size) of a file, or None if it doesn't exist. Cheap enough to check every input file on every poll"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class InventoryWatcher():
+    """
+        Keeps the parsed deployments, cloud configs and comparison results of an environment in memory
+        and brings them up to date with refresh(), redoing only the work the changed files affect
+    """
+    def __init__(self, environment: str = "production", revalidate: float = REVALIDATE_INTERVAL):
+        self.environment = environment
+        self.revalidate = revalidate
+        # Without PEF_CACHE_TTL_* cached PEF metadata is never revalidated, which only suits runs that end
+        for prefix, ttl in compare_pefs.CACHE_TTL.items():
+            if ttl is None:
+                compare_pefs.CACHE_TTL[prefix] = revalidate
+        self.deployments_dir = get_deployments_dir(environment)
+        # path -> file_state of every watched file at the last successful refresh
+        self.files: Dict[Path, Tuple] = {}
+        self.active_deployments: Set[str] = set()
+        # deployment file stem -> metadata.name, for every deployment file
+        self.deployment_names: Dict[str, str] = {}
+        # deployment file stem -> InferenceDeployment, for the active deployments parsed so far
+        self.deployments: Dict = {}
+        # read_studio_inventory() of the current studio csv, already prefetched
+        self.studio = None
+        # Model comparison rows of the last refresh, see compare_models.compare_models
+        self.model_comparison = None
+        self.revalidated_at = time.time()
+        # What the endpoints serve, replaced as a whole at the end of every refresh
+        self.state = {"generation": 0, "updated_at": None, "changed_files": [], "error": None, "cloud": [], "studio": [], "diff": {}, "delta": [], "metrics": {}}
+
+    def watched_files(self) -> Dict[Path, Tuple]:
+        """Return path -> file_state of every input file: deployment files, cluster tfvars, the studio inventory and the CONFIG_INPUTS"""
+        paths = [self.deployments_dir / f for f in os.listdir(self.deployments_dir)]
+        paths += list(get_cluster_files(self.environment).values())
+        paths += [STUDIO_INVENTORY_PATH] + CONFIG_INPUTS
+        return {path: file_state(path) for path in paths}
+
+    def poll(self) -> Dict[Path, Tuple]:
+        """Return the watched files once they are the same in two polls SETTLE_TIME apart"""
+        files = self.watched_files()
+        while True:
+            time.sleep(SETTLE_TIME)
+            settled = self.watched_files()
+            if settled == files:
+                return files
+            files = settled
+
+    def refresh(self, files: Dict[Path, Tuple]) -> bool:
+        """Bring the inventories up to date with files (see watched_files), return False if nothing changed"""
+        changed = {path for path in files.keys() | self.files.keys() if files.get(path) != self.files.get(path)}
+        revalidate = time.time() - self.revalidated_at >= self.revalidate
+        if revalidate:
+            print("Revalidating PEF metadata and checkpoint manifests")
+            compare_pefs.start_new_run()
+            compare_models.start_new_run()
+            self.revalidated_at = time.time()
+        elif not changed:
+            return False
+
+        # Metrics only cover the latest refresh, so they don't grow for as long as the watcher runs
+        METRICS.reset()
+        with METRICS.span("refresh", changed_files=len(changed)):
+            configs = self._update_deployments(changed)
+            with METRICS.span("write"):
+                cloud_inventory.write_inventory(configs)
+                cloud_inventory.write_inventory_gtm(configs)
+            studio_changed = self.studio is None or STUDIO_INVENTORY_PATH in changed
+            if studio_changed:
+                with METRICS.span("load"):
+                    self.studio = read_studio_inventory()
+            if studio_changed or revalidate:
+                with METRICS.span("compare/prefetch_artifactory"):
+                    prefetch_artifactory(self.studio[0].values())
+            # Revalidated checkpoints may have changed, so no model comparison is reused
+            comparer = InventoryComparer(configs, studio=self.studio, model_comparison=None if revalidate else self.model_comparison)
+            comparer.write()
+
+        results = comparer.compare()
+        self.files = files
+        self.model_comparison = results["model_comparison"]
+        self.state = {
+            "generation": self.state["generation"] + 1,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+            "changed_files": sorted(str(path) for path in changed),
+            "error": None,
+            "cloud": list(comparer.cloud_inventory.values()),
+            "studio": [to_typed_row(row) for row in comparer.studio_inventory.values()],
+            "diff": {name: [to_typed_row(row) for row in results[name]] for name, _, _ in comparer.outputs()},
+            "delta": comparer.delta,
+            "metrics": METRICS.summary(),
+        }
+        return True
+
+    def _update_deployments(self, changed: Set[Path]) -> Dict:
+        """Parse the deployment files that changed or became active, and merge all active deployments into cloud configs"""
+        if self.files and changed & set(CONFIG_INPUTS):
+            # Mappings and model defaults are baked into every parsed deployment
+            print("Configuration changed, parsing all deployments again")
+            CONFIG.reset()
+            self.deployments.clear()
+        with METRICS.span("load"):
+            # Cluster files that haven't changed are not parsed again, see tfvars.get_cluster_deployments
+            self.active_deployments = cloud_inventory.get_active_deployments(self.environment)
+
+        with METRICS.span("parse"):
+            deployment_configs = [self.deployments_dir / f for f in os.listdir(self.deployments_dir)]
+            names = {}
+            for config in deployment_configs:
+                name = self.deployment_names.get(config.stem)
+                if name is None or config in changed:
+                    name = cloud_inventory.read_deployment_name(config) or cloud_inventory.load_yaml(config)["metadata"]["name"]
+                    self.deployments.pop(config.stem, None)
+                names[config.stem] = name
+            # Deleted deployment files are dropped
+            self.deployment_names = names
+            self.deployments = {stem: d for stem, d in self.deployments.items() if stem in names}
+
+            active_configs = [config for config in deployment_configs if names[config.stem] in self.active_deployments]
+            to_parse = [config for config in active_configs if config.stem not in self.deployments]
+            print(f"Reusing {len(active_configs) - len(to_parse)} parsed deployments, parsing {len(to_parse)}")
+            for config, deployment in zip(to_parse, cloud_inventory.parse_deployments(to_parse)):
+                self.deployments[config.stem] = deployment
+        with METRICS.span("merge"):
+            # Same order as load_deployments, so the configs are merged in the same order
+            return cloud_inventory.get_cloud_configs({config.stem: self.deployments[config.stem] for config in active_configs})
+
+    def run(self, interval: float = POLL_INTERVAL):
+        """Poll and refresh forever. A failed refresh is reported and retried on the next poll, the previous state keeps being served"""
+        while True:
+            try:
+                if self.refresh(self.poll()):
+                    state = self.state
+                    print(f"Refreshed inventories (generation {state['generation']}, {len(state['changed_files'])} changed files)")
+            except Exception as e:
+                traceback.print_exc()
+                self.state = dict(self.state, error=f"{type(e).__name__}: {e}")
+            time.sleep(interval)
+
+
+def filter_rows(rows: List[Dict], query: Dict[str, str]) -> List[Dict]:
+    """Keep the rows whose columns match every query parameter, compared as strings"""
+    return [row for row in rows if all(str(row.get(column)) == value for column, value in query.items())]
+
+
+def make_handler(watcher: InventoryWatcher):
+    """Return a request handler class that serves the watcher's current state"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = dict(parse_qsl(url.query))
+            # The state is replaced as a whole by refresh(), a request only ever sees one generation
+            state = watcher.state
+            parts = [p for p in url.path.split("/") if p]
+            if parts == ["status"]:
+                body = {key: state[key] for key in ["generation", "updated_at", "changed_files", "error"]}
+                body["rows"] = {name: len(rows) for name, rows in state["diff"].items()}
+                body["rows"].update(cloud=len(state["cloud"]), studio=len(state["studio"]))
+            elif len(parts) == 2 and parts[0] == "inventory" and parts[1] in ("cloud", "studio"):
+                body = filter_rows(state[parts[1]], query)
+            elif len(parts) == 2 and parts[0] == "diff" and parts[1] in state["diff"]:
+                body = filter_rows(state["diff"][parts[1]], query)
+            elif parts == ["delta"]:
+                body = filter_rows(state["delta"] or [], query)
+            elif parts == ["metrics"]:
+                body = state["metrics"]
+            else:
+                self.send_error(404, f"Unknown endpoint {url.path}, see /status")
+                return
+            self._send_json(body)
+
+        def _send_json(self, body):
+            content = json.dumps(body, default=str).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            log(f"{self.address_string()} {format % args}")
+
+    return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--interval", type=float, default=POLL_INTERVAL, help="Seconds between two polls of the input files")
+    parser.add_argument("--revalidate", type=float, default=REVALIDATE_INTERVAL,
+                        help="Seconds after which cached PEF metadata (unless PEF_CACHE_TTL_* is set) and checkpoint manifests are looked up again")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure(args)
+
+    watcher = InventoryWatcher(revalidate=args.revalidate)
+    # The first build happens before serving, so the endpoints never serve an empty inventory
+    watcher.refresh(watcher.watched_files())
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(watcher))
+    threading.Thread(target=server.serve_forever, name="http", daemon=True).start()
+    print(f"Serving the inventories on http://{args.host}:{args.port}/status, polling every {args.interval:g}s")
+    try:
+        watcher.run(args.interval)
+    except KeyboardInterrupt:
+        server.shutdown()
+        metrics.finish(args)
@@ -0,0 +1,82 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import yaml
+from pathlib import Path
+from typing import Any, Dict, Union
+
+# Parsed yaml files are stored here as pickles, one per source file
+SNAPSHOT_DIR = Path(__file__).parent / ".yaml_snapshots"
+# Set YAML_SNAPSHOTS=0 to always parse yaml files
+SNAPSHOTS_ENABLED = os.environ.get("YAML_SNAPSHOTS", "1") != "0"
+
+# The libyaml C loader is much faster than the pure-Python one, use it when PyYAML was built with it
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def parse_yaml(content: Union[str, bytes]) -> Any:
+    """Parse yaml content with the fastest available safe loader"""
+    return yaml.load(content, Loader=SafeLoader)
+
+
+def _snapshot_file(path: Path) -> Path:
+    return SNAPSHOT_DIR / (hashlib.sha1(str(path).encode()).hexdigest() + ".pickle")
+
+
+def _read_fingerprint(snapshot_file: Path):
+    """Return (fingerprint, open file positioned at the parsed data) for a snapshot, or (None, None)"""
+    try:
+        f = open(snapshot_file, "rb")
+    except FileNotFoundError:
+        return None, None
+    try:
+        return pickle.load(f), f
+    except Exception:
+        f.close()
+        return None, None
+
+
+def _write_snapshot(snapshot_file: Path, fingerprint: Dict, data: Any):
+    """Write the snapshot atomically, so parallel readers never see a partial file"""
+    SNAPSHOT_DIR.mkdir(exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=SNAPSHOT_DIR, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        pickle.dump(fingerprint, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, snapshot_file)
+
+
+def load_yaml_snapshot(path: Union[str, Path]) -> Any:
+    """
+        Return the parsed contents of a yaml file, reusing the snapshot from a previous run if the file hasn't changed
+        A snapshot is reused without reading the file if its size and mtime match,
+        or after hashing the file if only the mtime changed (e.g. after a git checkout)
+    """
+    path = Path(path).resolve()
+    if not SNAPSHOTS_ENABLED:
+        with open(path, "rb") as f:
+            return parse_yaml(f.read())
+
+    stat = path.stat()
+    snapshot_file = _snapshot_file(path)
+    fingerprint, f = _read_fingerprint(snapshot_file)
+    if f is not None:
+        with f:
+            if fingerprint["size"] == stat.st_size and fingerprint["mtime_ns"] == stat.st_mtime_ns:
+                return pickle.load(f)
+
+    with open(path, "rb") as source:
+        content = source.read()
+    sha256 = hashlib.sha256(content).hexdigest()
+    new_fingerprint = {"path": str(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256}
+
+    if fingerprint is not None and fingerprint["sha256"] == sha256:
+        # Same content, just refresh the stat part of the fingerprint
+        with open(snapshot_file, "rb") as f:
+            pickle.load(f)
+            data = pickle.load(f)
+    else:
+        data = parse_yaml(content)
+    _write_snapshot(snapshot_file, new_fingerprint, data)
+    return data